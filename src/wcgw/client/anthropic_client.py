@@ -1,23 +1,37 @@
-import base64
-import json
-import mimetypes
+import asyncio
 import os
 import subprocess
 import tempfile
 import traceback
 import uuid
+from functools import lru_cache
 from pathlib import Path
-from typing import Literal, Optional, cast
+from typing import Any, AsyncIterator, Literal, Mapping, Optional, TypedDict, cast
 
+import orjson
 import rich
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic
+from anthropic.lib.streaming import AsyncMessageStreamManager
 from anthropic.types import (
+    ContentBlock,
+    ContentBlockParam,
     ImageBlockParam,
+    InputJSONDelta,
+    Message,
     MessageParam,
+    MessageStreamEvent,
+    RawContentBlockDeltaEvent,
+    RawContentBlockStartEvent,
+    RawContentBlockStopEvent,
     TextBlockParam,
     ToolParam,
     ToolResultBlockParam,
     ToolUseBlockParam,
+    Usage,
+)
+from anthropic.types.message_create_params import (
+    MessageCreateParamsBase,
+    MessageCreateParamsNonStreaming,
 )
 from dotenv import load_dotenv
 from typer import Typer
@@ -36,7 +50,24 @@ from ..types_ import (
     ScreenShot,
     WriteIfEmpty,
 )
-from .common import discard_input
+from .common import (
+    HISTORY_DIR,
+    IMAGE_COMMAND,
+    INTERRUPTED,
+    CostData,
+    StreamPrinter,
+    append_history,
+    chat_consoles,
+    diff_instructions,
+    discard_input,
+    encode_image_file,
+    history_id,
+    image_media_type,
+    in_thread,
+    load_history,
+    run_interruptible,
+    save_history,
+)
 from .memory import load_memory
 from .tools import (
     DoneFlag,
@@ -66,30 +97,33 @@ def text_from_editor(console: rich.console.Console) -> str:
             return data
 
 
-def save_history(history: History, session_id: str) -> None:
-    myid = str(history[1]["content"]).replace("/", "_").replace(" ", "_").lower()[:60]
-    myid += "_" + session_id
-    myid = myid + ".json"
-
-    mypath = Path(".wcgw") / myid
-    mypath.parent.mkdir(parents=True, exist_ok=True)
-    with open(mypath, "w") as f:
-        json.dump(history, f, indent=3)
+@lru_cache(maxsize=16)
+def _encode_image(path: str, mtime_ns: int, size: int) -> tuple[str, Optional[str]]:
+    # mtime and size only key the cache, so an edited image gets re-encoded
+    return encode_image_file(path), image_media_type(path)
 
 
 def parse_user_message_special(msg: str) -> MessageParam:
+    # Most messages have no special commands, keep them as a single text block
+    if "\n%" not in msg and not msg.startswith("%"):
+        return {"role": "user", "content": [{"type": "text", "text": msg}]}
+
     # Search for lines starting with `%` and treat them as special commands
     parts: list[ImageBlockParam | TextBlockParam] = []
+    # Text lines between commands, joined into one block per run
+    text_lines: list[str] = []
     for line in msg.split("\n"):
         if line.startswith("%"):
-            args = line[1:].strip().split(" ")
-            command = args[0]
-            assert command == "image"
-            image_path = " ".join(args[1:])
-            with open(image_path, "rb") as f:
-                image_bytes = f.read()
-                image_b64 = base64.b64encode(image_bytes).decode("utf-8")
-                image_type = mimetypes.guess_type(image_path)[0]
+            if text_lines:
+                parts.append({"type": "text", "text": "\n".join(text_lines)})
+                text_lines = []
+            command = IMAGE_COMMAND.match(line)
+            assert command is not None
+            image_path = command.group(1)
+            st = os.stat(image_path)
+            image_b64, image_type = _encode_image(
+                image_path, st.st_mtime_ns, st.st_size
+            )
             parts.append(
                 {
                     "type": "image",
@@ -104,54 +138,15 @@ def parse_user_message_special(msg: str) -> MessageParam:
                 }
             )
         else:
-            if len(parts) > 0 and parts[-1]["type"] == "text":
-                parts[-1]["text"] += "\n" + line
-            else:
-                parts.append({"type": "text", "text": line})
+            text_lines.append(line)
+    if text_lines:
+        parts.append({"type": "text", "text": "\n".join(text_lines)})
     return {"role": "user", "content": parts}
 
 
-app = Typer(pretty_exceptions_show_locals=False)
-
-
-@app.command()
-def loop(
-    first_message: Optional[str] = None,
-    limit: Optional[float] = None,
-    resume: Optional[str] = None,
-    computer_use: bool = False,
-) -> tuple[str, float]:
-    load_dotenv()
-
-    session_id = str(uuid.uuid4())[:6]
-
-    history: History = []
-    waiting_for_assistant = False
-    memory = None
-    if resume:
-        try:
-            _, memory, _ = load_memory(
-                resume,
-                8000,
-                lambda x: default_enc.encode(x).ids,
-                lambda x: default_enc.decode(x),
-            )
-        except OSError:
-            if resume == "latest":
-                resume_path = sorted(Path(".wcgw").iterdir(), key=os.path.getmtime)[-1]
-            else:
-                resume_path = Path(resume)
-            if not resume_path.exists():
-                raise FileNotFoundError(f"File {resume} not found")
-            with resume_path.open() as f:
-                history = json.load(f)
-            if len(history) <= 2:
-                raise ValueError("Invalid history file")
-            first_message = ""
-            waiting_for_assistant = history[-1]["role"] != "assistant"
-
-    limit = 1
-
+@lru_cache(maxsize=None)
+def _tools(computer_use: bool) -> list[ToolParam]:
+    # Building the schemas walks every pydantic model, do it once per process
     tools = [
         ToolParam(
             input_schema=BashCommand.model_json_schema(),
@@ -281,6 +276,243 @@ Saves provided description and file contents of all the relevant file paths or g
 """,
             ),
         ]
+    # Cache breakpoint after the tools, they are the same for the whole session
+    tools[-1]["cache_control"] = {"type": "ephemeral"}
+    return tools
+
+
+def _with_cache_breakpoint(history: History) -> History:
+    # Marks the last message so the next turn reads this turn's prefix from the
+    # prompt cache. Done on a copy, a request allows at most 4 breakpoints and
+    # the stored history shouldn't accumulate them.
+    if not history:
+        return history
+    last = history[-1]
+    content = last["content"]
+    blocks: list[ContentBlockParam | ContentBlock] = (
+        [TextBlockParam(type="text", text=content)]
+        if isinstance(content, str)
+        else list(content)
+    )
+    if not blocks:
+        return history
+    # Usually a tool_result or image block, any block type takes cache_control
+    marked = dict(cast(Mapping[str, Any], blocks[-1]))
+    marked["cache_control"] = {"type": "ephemeral"}
+    blocks[-1] = cast(ContentBlockParam, marked)
+    return [*history[:-1], {"role": last["role"], "content": blocks}]
+
+
+# claude-3-5-sonnet pricing
+COST_DATA = CostData(
+    cost_per_1m_input_tokens=3,
+    cost_per_1m_output_tokens=15,
+    cost_per_1m_cached_input_tokens=0.3,
+    cost_per_1m_cache_write_tokens=3.75,
+)
+
+
+def _usage_cost(usage: Usage) -> float:
+    # input_tokens excludes the tokens read from or written to the prompt cache
+    cache_read = usage.cache_read_input_tokens or 0
+    cache_write = usage.cache_creation_input_tokens or 0
+    return (
+        usage.input_tokens * COST_DATA.cost_per_1m_input_tokens
+        + cache_read * (COST_DATA.cost_per_1m_cached_input_tokens or 0)
+        + cache_write * (COST_DATA.cost_per_1m_cache_write_tokens or 0)
+        + usage.output_tokens * COST_DATA.cost_per_1m_output_tokens
+    ) / 1_000_000
+
+
+# Message Batches are billed at half the price of regular requests
+BATCH_DISCOUNT = 0.5
+
+MAX_OUTPUT_TOKENS = 8096
+
+
+def _max_output_tokens(
+    budget: float, price_factor: float = 1, input_cost: float = 0
+) -> int:
+    # Caps a turn to the output the remaining budget pays for after the turn's
+    # prompt, so the last turn stops at the cost limit instead of overshooting
+    # it by a full response
+    affordable = (
+        (budget - input_cost * price_factor)
+        * 1_000_000
+        / (COST_DATA.cost_per_1m_output_tokens * price_factor)
+    )
+    return max(1, min(MAX_OUTPUT_TOKENS, int(affordable)))
+
+
+def _input_cost_estimate(cached_tokens: int, new_tokens: int) -> float:
+    # Lower bound on a turn's prompt cost: the previous prompt is read back from
+    # the cache and what is known to be added since is written to it
+    return (
+        cached_tokens * (COST_DATA.cost_per_1m_cached_input_tokens or 0)
+        + new_tokens * (COST_DATA.cost_per_1m_cache_write_tokens or 0)
+    ) / 1_000_000
+
+
+class StreamedToolCall(TypedDict):
+    name: str
+    # input_json_delta fragments, joined when the block stops
+    input: list[str]
+    done: bool
+    id: str
+
+
+class BatchFailed(Exception):
+    pass
+
+
+class BatchedMessage:
+    """Gets a response through the Message Batches API instead of streaming it.
+
+    Used like the stream returned by ``client.messages.stream``: entering waits
+    for the batch to end and iterating replays the message as stream events, so
+    the loop handles both the same way.
+    """
+
+    def __init__(self, client: AsyncAnthropic, params: MessageCreateParamsBase) -> None:
+        self.client = client
+        self.params = params
+        self.message: Optional[Message] = None
+
+    async def __aenter__(self) -> "BatchedMessage":
+        batches = self.client.messages.batches
+        batch = await batches.create(
+            requests=[
+                {
+                    "custom_id": "turn",
+                    "params": MessageCreateParamsNonStreaming(
+                        **self.params, stream=False
+                    ),
+                }
+            ]
+        )
+        delay = 20
+        try:
+            while batch.processing_status != "ended":
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+                batch = await batches.retrieve(batch.id)
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            # The turn is redone, don't leave the abandoned batch running
+            await batches.cancel(batch.id)
+            raise
+        async for response in await batches.results(batch.id):
+            result = response.result
+            if result.type == "errored":
+                raise BatchFailed(
+                    f"Message batch request errored: {result.error.error.message}"
+                )
+            if result.type != "succeeded":
+                raise BatchFailed(f"Message batch request {result.type}")
+            self.message = result.message
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        pass
+
+    async def __aiter__(self) -> AsyncIterator[MessageStreamEvent]:
+        assert self.message is not None
+        for index, block in enumerate(self.message.content):
+            if block.type == "text":
+                yield RawContentBlockStartEvent(
+                    type="content_block_start", index=index, content_block=block
+                )
+            else:
+                yield RawContentBlockStartEvent(
+                    type="content_block_start",
+                    index=index,
+                    content_block=block.model_copy(update={"input": {}}),
+                )
+                yield RawContentBlockDeltaEvent(
+                    type="content_block_delta",
+                    index=index,
+                    delta=InputJSONDelta(
+                        type="input_json_delta",
+                        partial_json=orjson.dumps(block.input).decode(),
+                    ),
+                )
+            yield RawContentBlockStopEvent(type="content_block_stop", index=index)
+
+    async def get_final_message(self) -> Message:
+        assert self.message is not None
+        return self.message
+
+
+app = Typer(pretty_exceptions_show_locals=False)
+
+
+@app.command()
+def loop(
+    first_message: Optional[str] = None,
+    limit: Optional[float] = None,
+    resume: Optional[str] = None,
+    computer_use: bool = False,
+    batch: bool = False,
+) -> tuple[str, float]:
+    return asyncio.run(
+        run_interruptible(
+            aloop(
+                first_message=first_message,
+                limit=limit,
+                resume=resume,
+                computer_use=computer_use,
+                batch=batch,
+            )
+        )
+    )
+
+
+async def aloop(
+    first_message: Optional[str] = None,
+    limit: Optional[float] = None,
+    resume: Optional[str] = None,
+    computer_use: bool = False,
+    batch: bool = False,
+) -> tuple[str, float]:
+    load_dotenv()
+
+    session_id = str(uuid.uuid4())[:6]
+    # Set once the first user message is known, see history_id
+    saved_id: Optional[str] = None
+    n_saved = 0
+
+    history: History = []
+    waiting_for_assistant = False
+    memory = None
+    if resume:
+        try:
+            _, memory, _ = load_memory(
+                resume,
+                8000,
+                lambda x: default_enc.encode(x).ids,
+                lambda x: default_enc.decode(x),
+            )
+        except OSError:
+            if resume == "latest":
+                with os.scandir(HISTORY_DIR) as entries:
+                    latest = max(
+                        (e for e in entries if e.is_file()),
+                        key=lambda e: e.stat().st_mtime,
+                    )
+                resume_path = Path(latest.path)
+            else:
+                resume_path = Path(resume)
+            if not resume_path.exists():
+                raise FileNotFoundError(f"File {resume} not found")
+            history = load_history(resume_path)
+            if len(history) <= 2:
+                raise ValueError("Invalid history file")
+            first_message = ""
+            waiting_for_assistant = history[-1]["role"] != "assistant"
+
+    if limit is None:
+        limit = 1
+
+    tools = _tools(computer_use)
 
     system = initialize(
         os.getcwd(),
@@ -290,30 +522,30 @@ Saves provided description and file contents of all the relevant file paths or g
         mode="wcgw",
     )
 
-    with open(os.path.join(os.path.dirname(__file__), "diff-instructions.txt")) as f:
-        system += f.read()
+    system += diff_instructions()
 
     if history:
+        # Tool results are stored as a list of tool_result blocks
+        last_msg = history[-1]
+        content = last_msg["content"]
         if (
-            (last_msg := history[-1])["role"] == "user"
-            and isinstance((content := last_msg["content"]), dict)
-            and content["type"] == "tool_result"
+            last_msg["role"] == "user"
+            and isinstance(content, list)
+            and content
+            and content[-1]["type"] == "tool_result"
         ):
             waiting_for_assistant = True
 
-    client = Anthropic()
+    client = AsyncAnthropic()
 
     cost: float = 0
     input_toks = 0
     output_toks = 0
-    system_console = rich.console.Console(style="blue", highlight=False, markup=False)
-    error_console = rich.console.Console(style="red", highlight=False, markup=False)
-    user_console = rich.console.Console(
-        style="bright_black", highlight=False, markup=False
-    )
-    assistant_console = rich.console.Console(
-        style="white bold", highlight=False, markup=False
-    )
+    # Prompt of the next turn, the previous prompt plus its response. Before the
+    # first response only the system prompt is known.
+    prompt_cached_toks = 0
+    prompt_new_toks = len(default_enc.encode(system))
+    system_console, error_console, user_console, assistant_console = chat_consoles()
     while True:
         if cost > limit:
             system_console.print(
@@ -332,94 +564,121 @@ Saves provided description and file contents of all the relevant file paths or g
         else:
             waiting_for_assistant = False
 
-        cost_, input_toks_ = 0, 0
-        cost += cost_
-        input_toks += input_toks_
-
-        stream = client.messages.stream(
-            model="claude-3-5-sonnet-20241022",
-            messages=history,
-            tools=tools,
-            max_tokens=8096,
-            system=system,
-        )
+        params: MessageCreateParamsBase = {
+            "model": "claude-3-5-sonnet-20241022",
+            "messages": _with_cache_breakpoint(history),
+            "tools": tools,
+            "max_tokens": _max_output_tokens(
+                limit - cost,
+                BATCH_DISCOUNT if batch else 1,
+                _input_cost_estimate(prompt_cached_toks, prompt_new_toks),
+            ),
+            "system": [
+                TextBlockParam(
+                    type="text", text=system, cache_control={"type": "ephemeral"}
+                )
+            ],
+        }
+        stream: BatchedMessage | AsyncMessageStreamManager
+        if batch:
+            system_console.print("\nSubmitted as a message batch, waiting for it")
+            stream = BatchedMessage(client, params)
+        else:
+            stream = client.messages.stream(**params)
 
         system_console.print(
             "\n---------------------------------------\n# Assistant response",
             style="bold",
         )
         _histories: History = []
-        full_response: str = ""
+        full_response_parts: list[str] = []
 
-        tool_calls = []
+        tool_calls: list[StreamedToolCall] = []
         tool_results: list[ToolResultBlockParam] = []
+        printer = StreamPrinter(assistant_console)
         try:
-            with stream as stream_:
-                for chunk in stream_:
-                    type_ = chunk.type
-                    if type_ in {"message_start", "message_stop"}:
-                        continue
-                    elif type_ == "content_block_start" and hasattr(
-                        chunk, "content_block"
-                    ):
+            async with stream as stream_:
+                async for chunk in stream_:
+                    # Deltas are by far the most frequent event, test them first.
+                    # Events not handled here (message_start/stop, the SDK's
+                    # text and input_json copies of deltas) fall through.
+                    # Events are typed SDK models, so their fields are read
+                    # directly once the type is known.
+                    if chunk.type == "content_block_delta":
+                        delta = chunk.delta
+                        if delta.type == "text_delta":
+                            chunk_str = delta.text
+                            printer.write(chunk_str)
+                            full_response_parts.append(chunk_str)
+                        elif delta.type == "input_json_delta":
+                            tool_calls[-1]["input"].append(delta.partial_json)
+                        else:
+                            error_console.log(
+                                f"Ignoring unknown content block delta type {delta.type}"
+                            )
+                    elif chunk.type == "content_block_start":
                         content_block = chunk.content_block
-                        if (
-                            hasattr(content_block, "type")
-                            and content_block.type == "text"
-                            and hasattr(content_block, "text")
-                        ):
+                        if content_block.type == "text":
                             chunk_str = content_block.text
-                            assistant_console.print(chunk_str, end="")
-                            full_response += chunk_str
+                            printer.write(chunk_str)
+                            full_response_parts.append(chunk_str)
                         elif content_block.type == "tool_use":
-                            if (
-                                hasattr(content_block, "input")
-                                and hasattr(content_block, "name")
-                                and hasattr(content_block, "id")
-                            ):
-                                assert content_block.input == {}
-                                tool_calls.append(
-                                    {
-                                        "name": str(content_block.name),
-                                        "input": str(""),
-                                        "done": False,
-                                        "id": str(content_block.id),
-                                    }
-                                )
+                            assert content_block.input == {}
+                            tool_calls.append(
+                                {
+                                    "name": content_block.name,
+                                    "input": [],
+                                    "done": False,
+                                    "id": content_block.id,
+                                }
+                            )
                         else:
                             error_console.log(
                                 f"Ignoring unknown content block type {content_block.type}"
                             )
-                    elif type_ == "content_block_delta" and hasattr(chunk, "delta"):
-                        delta = chunk.delta
-                        if hasattr(delta, "type"):
-                            delta_type = str(delta.type)
-                            if delta_type == "text_delta" and hasattr(delta, "text"):
-                                chunk_str = delta.text
-                                assistant_console.print(chunk_str, end="")
-                                full_response += chunk_str
-                            elif delta_type == "input_json_delta" and hasattr(
-                                delta, "partial_json"
-                            ):
-                                partial_json = delta.partial_json
-                                if isinstance(tool_calls[-1]["input"], str):
-                                    tool_calls[-1]["input"] += partial_json
-                            else:
-                                error_console.log(
-                                    f"Ignoring unknown content block delta type {delta_type}"
-                                )
-                        else:
-                            raise ValueError("Content block delta has no type")
-                    elif type_ == "content_block_stop":
+                    elif chunk.type == "content_block_stop":
+                        printer.flush()
                         if tool_calls and not tool_calls[-1]["done"]:
                             tc = tool_calls[-1]
-                            tool_name = str(tc["name"])
-                            tool_input = str(tc["input"])
-                            tool_id = str(tc["id"])
+                            tool_name = tc["name"]
+                            tool_id = tc["id"]
+                            try:
+                                # Parsed once, the dict is both validated and
+                                # kept as the tool_use input in the history
+                                tool_input = orjson.loads("".join(tc["input"]))
+                            except orjson.JSONDecodeError:
+                                # Cut off by max_tokens, answer the partial call
+                                # with an error so the assistant can retry it
+                                tc["done"] = True
+                                error_console.print(
+                                    f"\nIncomplete input for tool {tool_name}"
+                                )
+                                _histories.append(
+                                    {
+                                        "role": "assistant",
+                                        "content": [
+                                            ToolUseBlockParam(
+                                                id=tool_id,
+                                                name=tool_name,
+                                                input={},
+                                                type="tool_use",
+                                            )
+                                        ],
+                                    }
+                                )
+                                tool_results.append(
+                                    ToolResultBlockParam(
+                                        type="tool_result",
+                                        tool_use_id=tool_id,
+                                        content="Tool call input was cut off by the output token limit, retry with a shorter input.",
+                                        is_error=True,
+                                    )
+                                )
+                                continue
 
-                            tool_parsed = which_tool_name(
-                                tool_name
-                            ).model_validate_json(tool_input)
+                            tool_parsed = which_tool_name(tool_name).model_validate(
+                                tool_input
+                            )
 
                             system_console.print(
                                 f"\n---------------------------------------\n# Assistant invoked tool: {tool_parsed}"
@@ -432,7 +691,7 @@ Saves provided description and file contents of all the relevant file paths or g
                                         ToolUseBlockParam(
                                             id=tool_id,
                                             name=tool_name,
-                                            input=tool_parsed.model_dump(),
+                                            input=tool_input,
                                             type="tool_use",
                                         )
                                     ],
@@ -443,7 +702,7 @@ Saves provided description and file contents of all the relevant file paths or g
                                     tool_parsed,
                                     default_enc,
                                     limit - cost,
-                                    loop,
+                                    in_thread(loop),
                                     max_tokens=8000,
                                 )
                             except Exception as e:
@@ -452,8 +711,13 @@ Saves provided description and file contents of all the relevant file paths or g
                                 ]
                                 tb = traceback.format_exc()
                                 error_console.print(str(output_or_dones) + "\n" + tb)
+                            # Later blocks' stop events must not run it again
+                            tc["done"] = True
 
                             if any(isinstance(x, DoneFlag) for x in output_or_dones):
+                                # Save this turn too, it's not merged until it ends
+                                history.extend(_histories)
+                                save_history(history, session_id)
                                 return "", cost
 
                             tool_results_content: list[
@@ -483,11 +747,14 @@ Saves provided description and file contents of all the relevant file paths or g
                             tool_results.append(
                                 ToolResultBlockParam(
                                     type="tool_result",
-                                    tool_use_id=str(tc["id"]),
+                                    tool_use_id=tool_id,
                                     content=tool_results_content,
                                 )
                             )
                         else:
+                            full_response = "".join(full_response_parts)
+                            # Each text block becomes its own message
+                            full_response_parts.clear()
                             _histories.append(
                                 {
                                     "role": "assistant",
@@ -497,16 +764,53 @@ Saves provided description and file contents of all the relevant file paths or g
                                 }  # Fixes anthropic issue of non empty response only
                             )
 
-        except KeyboardInterrupt:
+                final_message = await stream_.get_final_message()
+            if final_message.stop_reason == "max_tokens":
+                system_console.print(
+                    "\nResponse cut off at the output token limit for this turn"
+                )
+            usage = final_message.usage
+            cost += _usage_cost(usage) * (BATCH_DISCOUNT if batch else 1)
+            cache_read = usage.cache_read_input_tokens or 0
+            prompt_toks = (
+                usage.input_tokens
+                + cache_read
+                + (usage.cache_creation_input_tokens or 0)
+            )
+            input_toks += prompt_toks
+            output_toks += usage.output_tokens
+            prompt_cached_toks = prompt_toks
+            prompt_new_toks = usage.output_tokens
+            system_console.print(
+                f"\nPrompt cache hit: {cache_read}/{prompt_toks} tokens, total cost: ${cost:.3f}"
+            )
+        except (KeyboardInterrupt, asyncio.CancelledError) as e:
+            printer.flush()
+            if isinstance(e, asyncio.CancelledError):
+                if e.args != (INTERRUPTED,):
+                    raise
+                current_task = asyncio.current_task()
+                assert current_task is not None
+                current_task.uncancel()
             waiting_for_assistant = False
             input("Interrupted...enter to redo the current turn")
+        except BatchFailed as e:
+            error_console.print(str(e))
+            # Nothing was added to the history, send the same request again
+            waiting_for_assistant = True
+            input("Batch failed...enter to retry the current turn")
         else:
             history.extend(_histories)
             if tool_results:
                 history.append({"role": "user", "content": tool_results})
                 waiting_for_assistant = True
-            save_history(history, session_id)
+            if saved_id is None:
+                saved_id = history_id(history, session_id)
+            append_history(history[n_saved:], saved_id)
+            n_saved = len(history)
 
+    if len(history) > 1:
+        save_history(history, session_id)
     return "Couldn't finish the task", cost
 
 
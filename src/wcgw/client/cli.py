@@ -3,9 +3,6 @@ from typing import Optional
 from typer import Typer
 import typer
 
-from .openai_client import loop as openai_loop
-from .anthropic_client import loop as claude_loop
-
 
 app = Typer(pretty_exceptions_show_locals=False)
 
@@ -17,20 +14,32 @@ def loop(
     limit: Optional[float] = None,
     resume: Optional[str] = None,
     computer_use: bool = False,
+    batch: bool = False,
     version: bool = typer.Option(False, "--version", "-v"),
 ) -> tuple[str, float]:
     if version:
         version_ = importlib.metadata.version("wcgw")
         print(f"wcgw version: {version_}")
         exit()
+    # Clients are imported on use, so only the selected SDK gets loaded
     if claude:
+        from .anthropic_client import loop as claude_loop
+
         return claude_loop(
             first_message=first_message,
             limit=limit,
             resume=resume,
             computer_use=computer_use,
+            batch=batch,
         )
     else:
+        if batch:
+            # Only the Anthropic client submits message batches
+            raise typer.BadParameter(
+                "only supported together with --claude", param_hint="--batch"
+            )
+        from .openai_client import loop as openai_loop
+
         return openai_loop(
             first_message=first_message,
             limit=limit,
@@ -1,14 +1,43 @@
+import asyncio
+import atexit
+import hashlib
+import mimetypes
+import mmap
+import os
+import re
 import select
+import signal
 import sys
 import termios
+import threading
+import time
 import tty
-from typing import Literal
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from pathlib import Path
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Coroutine,
+    Literal,
+    NamedTuple,
+    Optional,
+    Sequence,
+)
+
+import orjson
+import pybase64
+import rich
 from pydantic import BaseModel
 
 
 class CostData(BaseModel):
     cost_per_1m_input_tokens: float
     cost_per_1m_output_tokens: float
+    # Prompt cache pricing, None when the provider bills cached tokens in full
+    cost_per_1m_cached_input_tokens: Optional[float] = None
+    cost_per_1m_cache_write_tokens: Optional[float] = None
 
 
 from openai.types.chat import (
@@ -21,6 +50,224 @@ from openai.types.chat import (
 History = list[ChatCompletionMessageParam]
 Models = Literal["gpt-4o-2024-08-06", "gpt-4o-mini"]
 
+HISTORY_DIR = Path(".wcgw")
+
+# `%image <path>` lines in user messages attach an image
+IMAGE_COMMAND = re.compile(r"%\s*image\s+(.+?)\s*$")
+
+# Common image types, so mimetypes only loads its tables for anything else
+IMAGE_MEDIA_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
+
+
+def encode_image_file(path: str) -> str:
+    with open(path, "rb") as f:
+        # mmap can't map an empty file, there's nothing to encode anyway
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        # Encode straight from the mapped file, without reading it into bytes first
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return pybase64.b64encode_as_string(mm)
+
+
+def image_media_type(path: str) -> Optional[str]:
+    media_type = IMAGE_MEDIA_TYPES.get(os.path.splitext(path)[1].lower())
+    if media_type is None:
+        media_type = mimetypes.guess_type(path)[0]
+    return media_type
+
+
+@cache
+def diff_instructions() -> str:
+    with open(os.path.join(os.path.dirname(__file__), "diff-instructions.txt")) as f:
+        return f.read()
+
+
+_HISTORY_ID_TRANS = str.maketrans({"/": "_", " ": "_"})
+
+
+def history_id(history: Sequence[Any], session_id: str) -> str:
+    content = history[1]["content"] if len(history) > 1 else ""
+    # Both steps map characters one by one, so only the kept prefix is converted
+    myid = str(content)[:60].translate(_HISTORY_ID_TRANS).lower()[:60]
+    return myid + "_" + session_id
+
+
+@cache
+def _history_file(path: str) -> BinaryIO:
+    # Kept open for the rest of the session, each turn is a single write
+    try:
+        f = open(path, "ab")
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(path, "ab")
+    atexit.register(f.close)
+    return f
+
+
+# Tool outputs repeat a lot (re-read files, same listings), large ones are
+# stored once under blobs/ by content hash and referenced from the history
+BLOB_REF = "$blob"
+BLOB_MIN_SIZE = 1024
+_stored_blobs: set[str] = set()
+
+
+def _blob_ref(content: Any, blobs_dir: str) -> Any:
+    data = orjson.dumps(content)
+    if len(data) < BLOB_MIN_SIZE:
+        return content
+    digest = hashlib.sha256(data).hexdigest()
+    path = os.path.join(blobs_dir, digest)
+    if path not in _stored_blobs:
+        if not os.path.exists(path):
+            os.makedirs(blobs_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        _stored_blobs.add(path)
+    return {BLOB_REF: digest}
+
+
+def _load_blob(content: Any, blobs_dir: Path, loaded: dict[str, Any]) -> Any:
+    if isinstance(content, dict) and BLOB_REF in content:
+        # Repeated outputs are read once and shared by every message using them
+        digest = content[BLOB_REF]
+        if digest not in loaded:
+            loaded[digest] = orjson.loads((blobs_dir / digest).read_bytes())
+        return loaded[digest]
+    return content
+
+
+def _map_tool_outputs(item: Any, fn: Callable[[Any], Any]) -> Any:
+    # Tool outputs are the content of "tool" messages (OpenAI) and of
+    # tool_result blocks in user messages (Anthropic)
+    content = item.get("content")
+    if item.get("role") == "tool":
+        return {**item, "content": fn(content)}
+    if item.get("role") == "user" and isinstance(content, list):
+        return {
+            **item,
+            "content": [
+                {**block, "content": fn(block["content"])}
+                if block.get("type") == "tool_result" and "content" in block
+                else block
+                for block in content
+            ],
+        }
+    return item
+
+
+def save_history(history: Sequence[Any], session_id: str) -> None:
+    mypath = HISTORY_DIR / (history_id(history, session_id) + ".json")
+    data = orjson.dumps(history, option=orjson.OPT_INDENT_2)
+    try:
+        f = open(mypath, "wb")
+    except FileNotFoundError:
+        # Only the first save of a fresh directory needs to create it
+        HISTORY_DIR.mkdir(parents=True, exist_ok=True)
+        f = open(mypath, "wb")
+    with f:
+        f.write(data)
+
+
+def append_history(items: Sequence[Any], myid: str) -> None:
+    # One message per line, so each turn only writes its new messages
+    mypath = os.path.abspath(HISTORY_DIR / (myid + ".jsonl"))
+    blobs_dir = os.path.join(os.path.dirname(mypath), "blobs")
+    f = _history_file(mypath)
+    f.write(
+        b"".join(
+            orjson.dumps(_map_tool_outputs(item, lambda c: _blob_ref(c, blobs_dir)))
+            + b"\n"
+            for item in items
+        )
+    )
+    f.flush()
+
+
+def load_history(path: Path) -> list[Any]:
+    data = path.read_bytes()
+    if path.suffix != ".jsonl":
+        # save_history files hold the whole history as one JSON array
+        saved: list[Any] = orjson.loads(data)
+        return saved
+    history = []
+    blobs_dir = path.parent / "blobs"
+    loaded: dict[str, Any] = {}
+    lines = data.splitlines()
+    for i, line in enumerate(lines):
+        if not line:
+            continue
+        try:
+            item = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # A session killed mid-write can leave a partial last line
+            if i == len(lines) - 1:
+                break
+            raise
+        history.append(
+            _map_tool_outputs(item, lambda c: _load_blob(c, blobs_dir, loaded))
+        )
+    return history
+
+
+class ChatConsoles(NamedTuple):
+    system: rich.console.Console
+    error: rich.console.Console
+    user: rich.console.Console
+    assistant: rich.console.Console
+
+
+@cache
+def chat_consoles() -> ChatConsoles:
+    # Shared by every loop call in the process, including nested ones from tools
+    return ChatConsoles(
+        system=rich.console.Console(style="blue", highlight=False, markup=False),
+        error=rich.console.Console(style="red", highlight=False, markup=False),
+        user=rich.console.Console(style="bright_black", highlight=False, markup=False),
+        assistant=rich.console.Console(
+            style="white bold", highlight=False, markup=False
+        ),
+    )
+
+
+class StreamPrinter:
+    """Prints streamed text in batches instead of one console call per delta."""
+
+    def __init__(
+        self,
+        console: rich.console.Console,
+        max_parts: int = 32,
+        max_delay: float = 0.05,
+    ) -> None:
+        self.console = console
+        self.max_parts = max_parts
+        self.max_delay = max_delay
+        self._parts: list[str] = []
+        self._last_flush = time.monotonic()
+
+    def write(self, text: str) -> None:
+        if not text:
+            return
+        self._parts.append(text)
+        if (
+            len(self._parts) >= self.max_parts
+            or time.monotonic() - self._last_flush > self.max_delay
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        if self._parts:
+            self.console.print("".join(self._parts), end="")
+            self._parts.clear()
+        self._last_flush = time.monotonic()
+
 
 def discard_input() -> None:
     try:
@@ -49,3 +296,44 @@ def discard_input() -> None:
     except (termios.error, ValueError) as e:
         # Handle the error gracefully
         print(f"Warning: Unable to discard input. Error: {e}")
+
+
+INTERRUPTED = "Interrupted by user"
+
+
+async def run_interruptible(
+    coro: Coroutine[Any, Any, tuple[str, float]],
+) -> tuple[str, float]:
+    # Ctrl-C raises KeyboardInterrupt while the loop runs blocking code (tools),
+    # and cancels the pending await (e.g. the response stream) otherwise, so
+    # either way the current turn is interrupted and can be redone.
+    task = asyncio.current_task()
+    assert task is not None
+    event_loop = asyncio.get_running_loop()
+
+    def on_sigint(signum: int, frame: object) -> None:
+        if asyncio.current_task() is not None:
+            raise KeyboardInterrupt
+        task.cancel(INTERRUPTED)
+        event_loop.call_soon_threadsafe(lambda: None)
+
+    previous_handler = None
+    if threading.current_thread() is threading.main_thread():
+        previous_handler = signal.signal(signal.SIGINT, on_sigint)
+    try:
+        return await coro
+    finally:
+        if previous_handler is not None:
+            signal.signal(signal.SIGINT, previous_handler)
+
+
+def in_thread(
+    loop_call: Callable[[str, float], tuple[str, float]],
+) -> Callable[[str, float], tuple[str, float]]:
+    # Tools run inside the client's event loop, where a nested loop() can't
+    # asyncio.run, so run it on its own thread with its own event loop.
+    def call(first_message: str, limit: float) -> tuple[str, float]:
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            return pool.submit(loop_call, first_message, limit).result()
+
+    return call
@@ -1,6 +1,5 @@
 """Computer Use Tool for Anthropic API"""
 
-import base64
 import time
 import shlex
 import os
@@ -10,6 +9,7 @@ from enum import StrEnum
 from typing import Any, Literal, TypedDict, Union, Optional
 from uuid import uuid4
 
+import pybase64
 from anthropic.types.beta import BetaToolComputerUse20241022Param, BetaToolUnionParam
 from .sys_utils import command_run
 from ..types_ import (
@@ -342,7 +342,7 @@ class ComputerTool:
 
         if os.path.exists(path):
             with open(path, "rb") as f:
-                base64_image = base64.b64encode(f.read()).decode("utf-8")
+                base64_image = pybase64.b64encode_as_string(f.read())
 
             return ToolResult(output="", error=stderr, base64_image=base64_image)
 
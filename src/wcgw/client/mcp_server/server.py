@@ -1,8 +1,8 @@
 import importlib
-import json
-import os
+from functools import lru_cache
 from typing import Any
 
+import orjson
 from pydantic import AnyUrl, ValidationError
 
 import mcp_wcgw.server.stdio
@@ -27,6 +27,7 @@ from ...types_ import (
     WriteIfEmpty,
 )
 from .. import tools
+from ..common import diff_instructions
 from ..computer_use import SLEEP_TIME_MAX_S
 from ..modes import get_kt_prompt
 from ..tools import DoneFlag, default_enc, get_tool_output, which_tool_name
@@ -84,14 +85,12 @@ async def handle_list_tools() -> list[types.Tool]:
     List available tools.
     Each tool specifies its arguments using JSON Schema validation.
     """
+    return _tools(COMPUTER_USE_ON_DOCKER_ENABLED)
 
-    with open(
-        os.path.join(
-            os.path.dirname(os.path.dirname(__file__)), "diff-instructions.txt"
-        )
-    ) as f:
-        diffinstructions = f.read()
 
+@lru_cache(maxsize=None)
+def _tools(computer_use: bool) -> list[types.Tool]:
+    # Building the schemas walks every pydantic model, do it once per process
     tools = [
         ToolParam(
             inputSchema=Initialize.model_json_schema(),
@@ -176,7 +175,7 @@ async def handle_list_tools() -> list[types.Tool]:
 - Use SEARCH/REPLACE blocks to edit the file.
 - If the edit fails due to block not matching, please retry with correct block till it matches. Re-read the file to ensure you've all the lines correct.
 """
-            + diffinstructions,
+            + diff_instructions(),
         ),
         ToolParam(
             inputSchema=ContextSave.model_json_schema(),
@@ -187,7 +186,7 @@ Saves provided description and file contents of all the relevant file paths or g
 - Leave project path as empty string if no project path""",
         ),
     ]
-    if COMPUTER_USE_ON_DOCKER_ENABLED:
+    if computer_use:
         tools += [
             ToolParam(
                 inputSchema=GetScreenInfo.model_json_schema(),
@@ -257,8 +256,8 @@ async def handle_call_tool(
             if not isinstance(x, str):
                 return x
             try:
-                return json.loads(x)
-            except json.JSONDecodeError:
+                return orjson.loads(x)
+            except orjson.JSONDecodeError:
                 return x
 
         tool_call = tool_type(**{k: try_json(v) for k, v in arguments.items()})
@@ -53,8 +53,11 @@ def save_memory(
     # Save bash state if provided
     if bash_state_dict is not None:
         state_file = os.path.join(memory_dir, f"{task_id}_bash_state.json")
-        with open(state_file, "w") as f:
-            json.dump(bash_state_dict, f, indent=2)
+        # Replaced in one step, so a resume never reads a half written state
+        tmp_file = f"{state_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(bash_state_dict, f, separators=(",", ":"))
+        os.replace(tmp_file, state_file)
 
     return memory_file_full
 
@@ -1,25 +1,29 @@
-import base64
-import json
-import mimetypes
+import asyncio
 import os
 import subprocess
 import tempfile
+import threading
 import traceback
 import uuid
+from functools import lru_cache
 from pathlib import Path
-from typing import DefaultDict, Optional, cast
+from typing import Optional, cast
 
 import openai
+import orjson
 import petname  # type: ignore[import-untyped]
 import rich
 import tokenizers  # type: ignore[import-untyped]
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, AsyncStream
 from openai.types.chat import (
+    ChatCompletionChunk,
     ChatCompletionContentPartParam,
     ChatCompletionMessageParam,
+    ChatCompletionToolParam,
     ChatCompletionUserMessageParam,
 )
+from openai.types.completion_usage import CompletionUsage
 from pydantic import BaseModel
 from typer import Typer
 
@@ -33,9 +37,28 @@ from ..types_ import (
     ResetShell,
     WriteIfEmpty,
 )
-from .common import CostData, History, Models, discard_input
+from .common import (
+    HISTORY_DIR,
+    IMAGE_COMMAND,
+    INTERRUPTED,
+    CostData,
+    History,
+    Models,
+    StreamPrinter,
+    append_history,
+    chat_consoles,
+    diff_instructions,
+    discard_input,
+    encode_image_file,
+    history_id,
+    image_media_type,
+    in_thread,
+    load_history,
+    run_interruptible,
+    save_history,
+)
 from .memory import load_memory
-from .openai_utils import get_input_cost, get_output_cost
+from .openai_utils import get_usage_cost
 from .tools import (
     DoneFlag,
     ImageData,
@@ -53,6 +76,11 @@ class Config(BaseModel):
     cost_unit: str = "$"
 
 
+@lru_cache(maxsize=None)
+def _load_encoder(name: str) -> tokenizers.Tokenizer:
+    return tokenizers.Tokenizer.from_pretrained(name)
+
+
 def text_from_editor(console: rich.console.Console) -> str:
     # First consume all the input till now
     discard_input()
@@ -69,101 +97,83 @@ def text_from_editor(console: rich.console.Console) -> str:
             return data
 
 
-def save_history(history: History, session_id: str) -> None:
-    myid = str(history[1]["content"]).replace("/", "_").replace(" ", "_").lower()[:60]
-    myid += "_" + session_id
-    myid = myid + ".json"
+async def _input_async() -> str:
+    # input() in a daemon thread, an interrupted prompt shouldn't hold up exit
+    loop = asyncio.get_running_loop()
+    fut: asyncio.Future[str] = loop.create_future()
 
-    mypath = Path(".wcgw") / myid
-    mypath.parent.mkdir(parents=True, exist_ok=True)
-    with open(mypath, "w") as f:
-        json.dump(history, f, indent=3)
+    def resolve(data: str | None, exc: BaseException | None) -> None:
+        if fut.done():
+            return
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(cast(str, data))
+
+    def read() -> None:
+        try:
+            data = input()
+        except BaseException as e:
+            loop.call_soon_threadsafe(resolve, None, e)
+        else:
+            loop.call_soon_threadsafe(resolve, data, None)
+
+    threading.Thread(target=read, daemon=True).start()
+    return await fut
+
+
+async def text_from_editor_async(console: rich.console.Console) -> str:
+    # Same as text_from_editor, but waits for input without blocking the event loop
+    discard_input()
+    console.print("\n---------------------------------------\n# User message")
+    data = await _input_async()
+    if data:
+        return data
+    editor = os.environ.get("EDITOR", "vim")
+    with tempfile.NamedTemporaryFile(suffix=".tmp") as tf:
+        proc = await asyncio.create_subprocess_exec(editor, tf.name)
+        returncode = await proc.wait()
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, [editor, tf.name])
+        with open(tf.name, "r") as f:
+            data = f.read()
+            console.print(data)
+            return data
 
 
 def parse_user_message_special(msg: str) -> ChatCompletionUserMessageParam:
+    # Most messages have no special commands, keep them as a single text part
+    if "\n%" not in msg and not msg.startswith("%"):
+        return {"role": "user", "content": [{"type": "text", "text": msg}]}
+
     # Search for lines starting with `%` and treat them as special commands
     parts: list[ChatCompletionContentPartParam] = []
+    # Text lines between commands, joined into one part per run
+    text_lines: list[str] = []
     for line in msg.split("\n"):
         if line.startswith("%"):
-            args = line[1:].strip().split(" ")
-            command = args[0]
-            assert command == "image"
-            image_path = " ".join(args[1:])
-            with open(image_path, "rb") as f:
-                image_bytes = f.read()
-                image_b64 = base64.b64encode(image_bytes).decode("utf-8")
-                image_type = mimetypes.guess_type(image_path)[0]
-                dataurl = f"data:{image_type};base64,{image_b64}"
+            if text_lines:
+                parts.append({"type": "text", "text": "\n".join(text_lines)})
+                text_lines = []
+            command = IMAGE_COMMAND.match(line)
+            assert command is not None
+            image_path = command.group(1)
+            image_b64 = encode_image_file(image_path)
+            image_type = image_media_type(image_path)
+            dataurl = f"data:{image_type};base64,{image_b64}"
             parts.append(
                 {"type": "image_url", "image_url": {"url": dataurl, "detail": "auto"}}
             )
         else:
-            if len(parts) > 0 and parts[-1]["type"] == "text":
-                parts[-1]["text"] += "\n" + line
-            else:
-                parts.append({"type": "text", "text": line})
+            text_lines.append(line)
+    if text_lines:
+        parts.append({"type": "text", "text": "\n".join(text_lines)})
     return {"role": "user", "content": parts}
 
 
-app = Typer(pretty_exceptions_show_locals=False)
-
-
-@app.command()
-def loop(
-    first_message: Optional[str] = None,
-    limit: Optional[float] = None,
-    resume: Optional[str] = None,
-    computer_use: bool = False,
-) -> tuple[str, float]:
-    load_dotenv()
-
-    session_id = str(uuid.uuid4())[:6]
-
-    history: History = []
-    waiting_for_assistant = False
-
-    memory = None
-    if resume:
-        try:
-            _, memory, _ = load_memory(
-                resume,
-                8000,
-                lambda x: default_enc.encode(x).ids,
-                lambda x: default_enc.decode(x),
-            )
-        except OSError:
-            if resume == "latest":
-                resume_path = sorted(Path(".wcgw").iterdir(), key=os.path.getmtime)[-1]
-            else:
-                resume_path = Path(resume)
-            if not resume_path.exists():
-                raise FileNotFoundError(f"File {resume} not found")
-            with resume_path.open() as f:
-                history = json.load(f)
-            if len(history) <= 2:
-                raise ValueError("Invalid history file")
-            first_message = ""
-            waiting_for_assistant = history[-1]["role"] != "assistant"
-
-    my_dir = os.path.dirname(__file__)
-
-    config = Config(
-        model=cast(Models, os.getenv("OPENAI_MODEL", "gpt-4o-2024-08-06").lower()),
-        cost_limit=0.1,
-        cost_unit="$",
-        cost_file={
-            "gpt-4o-2024-08-06": CostData(
-                cost_per_1m_input_tokens=5, cost_per_1m_output_tokens=15
-            ),
-        },
-    )
-
-    if limit is not None:
-        config.cost_limit = limit
-    limit = config.cost_limit
-
-    enc = tokenizers.Tokenizer.from_pretrained("Xenova/gpt-4o")
-
+@lru_cache(maxsize=None)
+def _tools() -> list[ChatCompletionToolParam]:
+    # Building the schemas walks every pydantic model, do it once per process
     tools = [
         openai.pydantic_function_tool(
             BashCommand,
@@ -226,6 +236,106 @@ Saves provided description and file contents of all the relevant file paths or g
 - Leave project path as empty string if no project path""",
         ),
     ]
+    return tools
+
+
+app = Typer(pretty_exceptions_show_locals=False)
+
+
+async def _final_usage(
+    stream: AsyncStream[ChatCompletionChunk],
+) -> Optional[CompletionUsage]:
+    # With include_usage the usage comes in a last chunk without choices, after
+    # the one carrying the finish reason
+    usage = None
+    async for chunk in stream:
+        if chunk.usage:
+            usage = chunk.usage
+    return usage
+
+
+@app.command()
+def loop(
+    first_message: Optional[str] = None,
+    limit: Optional[float] = None,
+    resume: Optional[str] = None,
+    computer_use: bool = False,
+) -> tuple[str, float]:
+    return asyncio.run(
+        run_interruptible(
+            aloop(
+                first_message=first_message,
+                limit=limit,
+                resume=resume,
+                computer_use=computer_use,
+            )
+        )
+    )
+
+
+async def aloop(
+    first_message: Optional[str] = None,
+    limit: Optional[float] = None,
+    resume: Optional[str] = None,
+    computer_use: bool = False,
+) -> tuple[str, float]:
+    load_dotenv()
+
+    session_id = str(uuid.uuid4())[:6]
+    # Set once the first user message is known, see history_id
+    saved_id: Optional[str] = None
+    n_saved = 0
+
+    history: History = []
+    waiting_for_assistant = False
+
+    memory = None
+    if resume:
+        try:
+            _, memory, _ = load_memory(
+                resume,
+                8000,
+                lambda x: default_enc.encode(x).ids,
+                lambda x: default_enc.decode(x),
+            )
+        except OSError:
+            if resume == "latest":
+                with os.scandir(HISTORY_DIR) as entries:
+                    latest = max(
+                        (e for e in entries if e.is_file()),
+                        key=lambda e: e.stat().st_mtime,
+                    )
+                resume_path = Path(latest.path)
+            else:
+                resume_path = Path(resume)
+            if not resume_path.exists():
+                raise FileNotFoundError(f"File {resume} not found")
+            history = load_history(resume_path)
+            if len(history) <= 2:
+                raise ValueError("Invalid history file")
+            first_message = ""
+            waiting_for_assistant = history[-1]["role"] != "assistant"
+
+    config = Config(
+        model=cast(Models, os.getenv("OPENAI_MODEL", "gpt-4o-2024-08-06").lower()),
+        cost_limit=0.1,
+        cost_unit="$",
+        cost_file={
+            "gpt-4o-2024-08-06": CostData(
+                cost_per_1m_input_tokens=5,
+                cost_per_1m_output_tokens=15,
+                cost_per_1m_cached_input_tokens=2.5,
+            ),
+        },
+    )
+
+    if limit is not None:
+        config.cost_limit = limit
+    limit = config.cost_limit
+
+    enc = _load_encoder("Xenova/gpt-4o")
+
+    tools = _tools()
 
     system = initialize(
         os.getcwd(),
@@ -235,8 +345,7 @@ Saves provided description and file contents of all the relevant file paths or g
         mode="wcgw",
     )
 
-    with open(os.path.join(os.path.dirname(__file__), "diff-instructions.txt")) as f:
-        system += f.read()
+    system += diff_instructions()
 
     if not history:
         history = [{"role": "system", "content": system}]
@@ -244,19 +353,15 @@ Saves provided description and file contents of all the relevant file paths or g
         if history[-1]["role"] == "tool":
             waiting_for_assistant = True
 
-    client = OpenAI()
+    client = AsyncOpenAI()
 
     cost: float = 0
     input_toks = 0
     output_toks = 0
-    system_console = rich.console.Console(style="blue", highlight=False, markup=False)
-    error_console = rich.console.Console(style="red", highlight=False, markup=False)
-    user_console = rich.console.Console(
-        style="bright_black", highlight=False, markup=False
-    )
-    assistant_console = rich.console.Console(
-        style="white bold", highlight=False, markup=False
-    )
+    system_console, error_console, user_console, assistant_console = chat_consoles()
+    # Fixed for the session
+    cost_data = config.cost_file[config.model]
+    cost_unit = config.cost_unit
     while True:
         if cost > limit:
             system_console.print(
@@ -269,22 +374,17 @@ Saves provided description and file contents of all the relevant file paths or g
                 msg = first_message
                 first_message = ""
             else:
-                msg = text_from_editor(user_console)
+                msg = await text_from_editor_async(user_console)
 
             history.append(parse_user_message_special(msg))
         else:
             waiting_for_assistant = False
 
-        cost_, input_toks_ = get_input_cost(
-            config.cost_file[config.model], enc, history
-        )
-        cost += cost_
-        input_toks += input_toks_
-
-        stream = client.chat.completions.create(
+        stream = await client.chat.completions.create(
             messages=history,
             model=config.model,
             stream=True,
+            stream_options={"include_usage": True},
             tools=tools,
         )
 
@@ -292,169 +392,185 @@ Saves provided description and file contents of all the relevant file paths or g
             "\n---------------------------------------\n# Assistant response",
             style="bold",
         )
-        tool_call_args_by_id = DefaultDict[str, DefaultDict[int, str]](
-            lambda: DefaultDict(str)
-        )
+        # Argument deltas per tool call, joined once the calls are complete
+        tool_call_args_by_id: dict[str, list[str]] = {}
         _histories: History = []
         item: ChatCompletionMessageParam
-        full_response: str = ""
+        full_response_parts: list[str] = []
         image_histories: History = []
+        printer = StreamPrinter(assistant_console)
         try:
-            for chunk in stream:
-                if chunk.choices[0].finish_reason == "tool_calls":
-                    assert tool_call_args_by_id
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason
+                if finish_reason:
+                    printer.flush()
+                    # Bill the turn from the server's usage instead of tokenizing
+                    usage = await _final_usage(stream)
+                    if usage:
+                        cost_, cached_toks = get_usage_cost(cost_data, usage)
+                        cost += cost_
+                        input_toks += usage.prompt_tokens
+                        output_toks += usage.completion_tokens
+                        system_console.print(
+                            f"Prompt cache hit: {cached_toks}/{usage.prompt_tokens} tokens"
+                        )
+                if finish_reason == "tool_calls":
+                    tool_args_by_id = {
+                        tool_call_id: "".join(parts)
+                        for tool_call_id, parts in tool_call_args_by_id.items()
+                    }
+                    # Parse every call's arguments once, reused below
+                    parsed_tools = {
+                        tool_call_id: which_tool(tool_args)
+                        for tool_call_id, tool_args in tool_args_by_id.items()
+                    }
                     item = {
                         "role": "assistant",
-                        "content": full_response,
+                        "content": "".join(full_response_parts),
                         "tool_calls": [
                             {
-                                "id": tool_call_id + str(toolindex),
+                                "id": tool_call_id,
                                 "type": "function",
                                 "function": {
                                     "arguments": tool_args,
-                                    "name": type(which_tool(tool_args)).__name__,
+                                    "name": type(parsed_tools[tool_call_id]).__name__,
                                 },
                             }
-                            for tool_call_id, toolcallargs in tool_call_args_by_id.items()
-                            for toolindex, tool_args in toolcallargs.items()
+                            for tool_call_id, tool_args in tool_args_by_id.items()
                         ],
                     }
-                    cost_, output_toks_ = get_output_cost(
-                        config.cost_file[config.model], enc, item
-                    )
-                    cost += cost_
                     system_console.print(
-                        f"\n---------------------------------------\n# Assistant invoked tools: {[which_tool(tool['function']['arguments']) for tool in item['tool_calls']]}"
+                        f"\n---------------------------------------\n# Assistant invoked tools: {list(parsed_tools.values())}"
                     )
-                    system_console.print(f"\nTotal cost: {config.cost_unit}{cost:.3f}")
-                    output_toks += output_toks_
+                    system_console.print(f"\nTotal cost: {cost_unit}{cost:.3f}")
 
                     _histories.append(item)
-                    for tool_call_id, toolcallargs in tool_call_args_by_id.items():
-                        for toolindex, tool_args in toolcallargs.items():
-                            try:
-                                output_or_dones, cost_ = get_tool_output(
-                                    json.loads(tool_args),
-                                    enc,
-                                    limit - cost,
-                                    loop,
-                                    max_tokens=8000,
-                                )
-                                output_or_done = output_or_dones[0]
-                            except Exception as e:
-                                output_or_done = (
-                                    f"GOT EXCEPTION while calling tool. Error: {e}"
-                                )
-                                tb = traceback.format_exc()
-                                error_console.print(output_or_done + "\n" + tb)
-                                cost_ = 0
-                            cost += cost_
-                            system_console.print(
-                                f"\nTotal cost: {config.cost_unit}{cost:.3f}"
+                    for tool_call_id, tool_args in tool_args_by_id.items():
+                        try:
+                            output_or_dones, cost_ = get_tool_output(
+                                parsed_tools[tool_call_id],
+                                enc,
+                                limit - cost,
+                                in_thread(loop),
+                                max_tokens=8000,
+                            )
+                            output_or_done = output_or_dones[0]
+                        except Exception as e:
+                            output_or_done = (
+                                f"GOT EXCEPTION while calling tool. Error: {e}"
                             )
+                            tb = traceback.format_exc()
+                            error_console.print(output_or_done + "\n" + tb)
+                            cost_ = 0
+                        cost += cost_
+                        system_console.print(f"\nTotal cost: {cost_unit}{cost:.3f}")
 
-                            if isinstance(output_or_done, DoneFlag):
-                                system_console.print(
-                                    f"\n# Task marked done, with output {output_or_done.task_output}",
-                                )
-                                system_console.print(
-                                    f"\nTotal cost: {config.cost_unit}{cost:.3f}"
-                                )
-                                return output_or_done.task_output, cost
-
-                            output = output_or_done
-
-                            if isinstance(output, ImageData):
-                                randomId = petname.Generate(2, "-")
-                                if not image_histories:
-                                    image_histories.extend(
-                                        [
-                                            {
-                                                "role": "assistant",
-                                                "content": f"Share images with ids: {randomId}",
-                                            },
-                                            {
-                                                "role": "user",
-                                                "content": [
-                                                    {
-                                                        "type": "image_url",
-                                                        "image_url": {
-                                                            "url": output.dataurl,
-                                                            "detail": "auto",
-                                                        },
-                                                    }
-                                                ],
-                                            },
-                                        ]
-                                    )
-                                else:
-                                    image_histories[0]["content"] += ", " + randomId
-                                    second_content = image_histories[1]["content"]
-                                    assert isinstance(second_content, list)
-                                    second_content.append(
+                        if isinstance(output_or_done, DoneFlag):
+                            system_console.print(
+                                f"\n# Task marked done, with output {output_or_done.task_output}",
+                            )
+                            system_console.print(f"\nTotal cost: {cost_unit}{cost:.3f}")
+                            # Save this turn too, it's not merged until it ends
+                            history.extend(_histories)
+                            save_history(history, session_id)
+                            return output_or_done.task_output, cost
+
+                        output = output_or_done
+
+                        if isinstance(output, ImageData):
+                            randomId = petname.Generate(2, "-")
+                            if not image_histories:
+                                image_histories.extend(
+                                    [
+                                        {
+                                            "role": "assistant",
+                                            "content": f"Share images with ids: {randomId}",
+                                        },
                                         {
-                                            "type": "image_url",
-                                            "image_url": {
-                                                "url": output.dataurl,
-                                                "detail": "auto",
-                                            },
-                                        }
-                                    )
-
-                                item = {
-                                    "role": "tool",
-                                    "content": f"Ask user for image id: {randomId}",
-                                    "tool_call_id": tool_call_id + str(toolindex),
-                                }
+                                            "role": "user",
+                                            "content": [
+                                                {
+                                                    "type": "image_url",
+                                                    "image_url": {
+                                                        "url": output.dataurl,
+                                                        "detail": "auto",
+                                                    },
+                                                }
+                                            ],
+                                        },
+                                    ]
+                                )
                             else:
-                                item = {
-                                    "role": "tool",
-                                    "content": str(output),
-                                    "tool_call_id": tool_call_id + str(toolindex),
-                                }
-                            cost_, output_toks_ = get_output_cost(
-                                config.cost_file[config.model], enc, item
-                            )
-                            cost += cost_
-                            output_toks += output_toks_
+                                image_histories[0]["content"] += ", " + randomId
+                                second_content = image_histories[1]["content"]
+                                assert isinstance(second_content, list)
+                                second_content.append(
+                                    {
+                                        "type": "image_url",
+                                        "image_url": {
+                                            "url": output.dataurl,
+                                            "detail": "auto",
+                                        },
+                                    }
+                                )
 
-                            _histories.append(item)
+                            item = {
+                                "role": "tool",
+                                "content": f"Ask user for image id: {randomId}",
+                                "tool_call_id": tool_call_id,
+                            }
+                        else:
+                            item = {
+                                "role": "tool",
+                                "content": str(output),
+                                "tool_call_id": tool_call_id,
+                            }
+                        _histories.append(item)
                     waiting_for_assistant = True
                     break
-                elif chunk.choices[0].finish_reason:
+                elif finish_reason:
                     assistant_console.print("")
                     item = {
                         "role": "assistant",
-                        "content": full_response,
+                        "content": "".join(full_response_parts),
                     }
-                    cost_, output_toks_ = get_output_cost(
-                        config.cost_file[config.model], enc, item
-                    )
-                    cost += cost_
-                    output_toks += output_toks_
-
-                    system_console.print(f"\nTotal cost: {config.cost_unit}{cost:.3f}")
+                    system_console.print(f"\nTotal cost: {cost_unit}{cost:.3f}")
                     _histories.append(item)
                     break
 
                 if chunk.choices[0].delta.tool_calls:
                     tool_call = chunk.choices[0].delta.tool_calls[0]
                     if tool_call.function and tool_call.function.arguments:
-                        tool_call_args_by_id[tool_call.id or ""][tool_call.index] += (
-                            tool_call.function.arguments
-                        )
+                        # Keyed by the id sent back to the API for this call
+                        tool_call_args_by_id.setdefault(
+                            (tool_call.id or "") + str(tool_call.index), []
+                        ).append(tool_call.function.arguments)
 
                 chunk_str = chunk.choices[0].delta.content or ""
-                assistant_console.print(chunk_str, end="")
-                full_response += chunk_str
-        except KeyboardInterrupt:
+                printer.write(chunk_str)
+                full_response_parts.append(chunk_str)
+        except (KeyboardInterrupt, asyncio.CancelledError) as e:
+            printer.flush()
+            if isinstance(e, asyncio.CancelledError):
+                if e.args != (INTERRUPTED,):
+                    raise
+                current_task = asyncio.current_task()
+                assert current_task is not None
+                current_task.uncancel()
             waiting_for_assistant = False
             input("Interrupted...enter to redo the current turn")
         else:
             history.extend(_histories)
             history.extend(image_histories)
-            save_history(history, session_id)
+            if saved_id is None:
+                saved_id = history_id(history, session_id)
+            append_history(history[n_saved:], saved_id)
+            n_saved = len(history)
 
+    if len(history) > 1:
+        save_history(history, session_id)
     return "Couldn't finish the task", cost
 
 
@@ -5,74 +5,37 @@ import sys
 import termios
 import traceback
 import tty
-from typing import Callable, DefaultDict, Literal, Optional, cast
+from typing import Callable, DefaultDict, Literal
 import openai
 from openai import OpenAI
-from openai.types.chat import (
-    ChatCompletionMessageParam,
-    ChatCompletionAssistantMessageParam,
-    ChatCompletionMessage,
-    ParsedChatCompletionMessage,
-)
+from openai.types.completion_usage import CompletionUsage
 import rich
-from tokenizers import Tokenizer  # type: ignore[import-untyped]
 from typer import Typer
 import uuid
 
-from .common import CostData, History
+from .common import CostData
 
 
-def get_input_cost(
-    cost_map: CostData, enc: Tokenizer, history: History
+def get_cached_input_discount(
+    cost_map: CostData, usage: CompletionUsage
 ) -> tuple[float, int]:
-    input_tokens = 0
-    for msg in history:
-        content = msg["content"]
-        refusal = msg.get("refusal")
-        if isinstance(content, list):
-            for part in content:
-                if "text" in part:
-                    input_tokens += len(enc.encode(part["text"]))
-        elif content is None:
-            if refusal is None:
-                raise ValueError("Expected content or refusal to be present")
-            input_tokens += len(enc.encode(str(refusal)))
-        elif not isinstance(content, str):
-            raise ValueError(f"Expected content to be string, got {type(content)}")
-        else:
-            input_tokens += len(enc.encode(content))
-    cost = input_tokens * cost_map.cost_per_1m_input_tokens / 1_000_000
-    return cost, input_tokens
+    # prompt_tokens counts cached tokens at full price, refund the cache discount
+    details = usage.prompt_tokens_details
+    cached_tokens = (details.cached_tokens or 0) if details else 0
+    if cost_map.cost_per_1m_cached_input_tokens is None:
+        return 0, cached_tokens
+    discount = (
+        cached_tokens
+        * (cost_map.cost_per_1m_input_tokens - cost_map.cost_per_1m_cached_input_tokens)
+        / 1_000_000
+    )
+    return discount, cached_tokens
 
 
-def get_output_cost(
-    cost_map: CostData,
-    enc: Tokenizer,
-    item: ChatCompletionMessage | ChatCompletionMessageParam,
-) -> tuple[float, int]:
-    if isinstance(item, ChatCompletionMessage):
-        content = item.content
-        if not isinstance(content, str):
-            raise ValueError(f"Expected content to be string, got {type(content)}")
-    else:
-        if not isinstance(item["content"], str):
-            raise ValueError(
-                f"Expected content to be string, got {type(item['content'])}"
-            )
-        content = item["content"]
-        if item["role"] == "tool":
-            return 0, 0
-    output_tokens = len(enc.encode(content))
-
-    if "tool_calls" in item:
-        item = cast(ChatCompletionAssistantMessageParam, item)
-        toolcalls = item["tool_calls"]
-        for tool_call in toolcalls or []:
-            output_tokens += len(enc.encode(tool_call["function"]["arguments"]))
-    elif isinstance(item, ParsedChatCompletionMessage):
-        if item.tool_calls:
-            for tool_callf in item.tool_calls:
-                output_tokens += len(enc.encode(tool_callf.function.arguments))
-
-    cost = output_tokens * cost_map.cost_per_1m_output_tokens / 1_000_000
-    return cost, output_tokens
+def get_usage_cost(cost_map: CostData, usage: CompletionUsage) -> tuple[float, int]:
+    discount, cached_tokens = get_cached_input_discount(cost_map, usage)
+    cost = (
+        usage.prompt_tokens * cost_map.cost_per_1m_input_tokens
+        + usage.completion_tokens * cost_map.cost_per_1m_output_tokens
+    ) / 1_000_000 - discount
+    return cost, cached_tokens
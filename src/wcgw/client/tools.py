@@ -1,9 +1,7 @@
-import base64
 import datetime
 import fnmatch
 import glob
 import importlib.metadata
-import json
 import mimetypes
 import os
 import re
@@ -22,9 +20,12 @@ from typing import (
     ParamSpec,
     Type,
     TypeVar,
+    get_args,
 )
 
+import orjson
 import pexpect
+import pybase64
 import pyte
 import rich
 import tokenizers  # type: ignore
@@ -88,6 +89,7 @@ console: rich.console.Console | DisableConsole = rich.console.Console(
 TIMEOUT = 5
 TIMEOUT_WHILE_OUTPUT = 20
 OUTPUT_WAIT_PATIENCE = 3
+UNAME = os.uname()
 
 
 def render_terminal_output(text: str) -> list[str]:
@@ -95,15 +97,15 @@ def render_terminal_output(text: str) -> list[str]:
     screen.set_mode(pyte.modes.LNM)
     stream = pyte.Stream(screen)
     stream.feed(text)
-    # Filter out empty lines
-    dsp = screen.display[::-1]
-    for i, line in enumerate(dsp):
-        if line.strip():
-            break
-    else:
-        i = len(dsp)
-    lines = screen.display[: len(dsp) - i]
-    return lines
+    # Rows are only added to the buffer once written to, so rows past the last
+    # key are blank. Taken before display, which adds every row.
+    end = max(screen.buffer, default=-1) + 1
+    # display renders all 500 lines on every access, so it's read once
+    lines = screen.display
+    # Filter out trailing empty lines
+    while end and not lines[end - 1].strip():
+        end -= 1
+    return lines[:end]
 
 
 def get_incremental_output(old_output: list[str], new_output: list[str]) -> list[str]:
@@ -493,9 +495,6 @@ def initialize(
         initial_files = read_files(read_files_, max_tokens)
         initial_files_context = f"---\n# Requested files\n{initial_files}\n---\n"
 
-    uname_sysname = os.uname().sysname
-    uname_machine = os.uname().machine
-
     mode_prompt = ""
     if BASH_STATE.mode == Modes.code_writer:
         mode_prompt = code_writer_prompt(
@@ -512,8 +511,8 @@ def initialize(
 {mode_prompt}
 
 # Environment
-System: {uname_sysname}
-Machine: {uname_machine}
+System: {UNAME.sysname}
+Machine: {UNAME.machine}
 Initialized in directory (also cwd): {BASH_STATE.cwd}
 
 {repo_context}
@@ -776,12 +775,12 @@ def execute_bash(
         if not second_wait_success:
             BASH_STATE.set_pending(text)
 
-            tokens = enc.encode(incremental_text)
-
-            if max_tokens and len(tokens) >= max_tokens:
-                incremental_text = "(...truncated)\n" + enc.decode(
-                    tokens.ids[-(max_tokens - 1) :]
-                )
+            if max_tokens and not fits_in_tokens(incremental_text, max_tokens):
+                tokens = enc.encode(incremental_text)
+                if len(tokens) >= max_tokens:
+                    incremental_text = "(...truncated)\n" + enc.decode(
+                        tokens.ids[-(max_tokens - 1) :]
+                    )
 
             if is_interrupt:
                 incremental_text = (
@@ -806,9 +805,10 @@ def execute_bash(
     output = _incremental_text(BASH_STATE.shell.before, BASH_STATE.pending_output)
     BASH_STATE.set_repl()
 
-    tokens = enc.encode(output)
-    if max_tokens and len(tokens) >= max_tokens:
-        output = "(...truncated)\n" + enc.decode(tokens.ids[-(max_tokens - 1) :])
+    if max_tokens and not fits_in_tokens(output, max_tokens):
+        tokens = enc.encode(output)
+        if len(tokens) >= max_tokens:
+            output = "(...truncated)\n" + enc.decode(tokens.ids[-(max_tokens - 1) :])
 
     try:
         exit_status = get_status()
@@ -848,8 +848,14 @@ def ensure_no_previous_output(func: Callable[Param, T]) -> Callable[Param, T]:
     return wrapper
 
 
+def fits_in_tokens(text: str, max_tokens: int) -> bool:
+    # The tokenizers are byte level, a text never has more tokens than UTF-8
+    # bytes (at most 4 per character), so short outputs skip tokenizing.
+    return len(text) * 4 < max_tokens
+
+
 def truncate_if_over(content: str, max_tokens: Optional[int]) -> str:
-    if max_tokens and max_tokens > 0:
+    if max_tokens and max_tokens > 0 and not fits_in_tokens(content, max_tokens):
         tokens = default_enc.encode(content)
         n_tokens = len(tokens)
         if n_tokens > max_tokens:
@@ -874,7 +880,7 @@ def read_image_from_shell(file_path: str) -> ImageData:
 
         with open(file_path, "rb") as image_file:
             image_bytes = image_file.read()
-            image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+            image_b64 = pybase64.b64encode_as_string(image_bytes)
             image_type = mimetypes.guess_type(file_path)[0]
             return ImageData(media_type=image_type, data=image_b64)  # type: ignore
     else:
@@ -887,7 +893,7 @@ def read_image_from_shell(file_path: str) -> ImageData:
             path_ = os.path.join(tmpdir, os.path.basename(file_path))
             with open(path_, "rb") as f:
                 image_bytes = f.read()
-            image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+            image_b64 = pybase64.b64encode_as_string(image_bytes)
             image_type = mimetypes.guess_type(file_path)[0]
             return ImageData(media_type=image_type, data=image_b64)  # type: ignore
 
@@ -1175,49 +1181,23 @@ TOOLS = (
     | ContextSave
 )
 
+TOOLS_ADAPTER = TypeAdapter[TOOLS](TOOLS, config={"extra": "forbid"})
+
 
 def which_tool(args: str) -> TOOLS:
-    adapter = TypeAdapter[TOOLS](TOOLS, config={"extra": "forbid"})
-    return adapter.validate_python(json.loads(args))
+    return TOOLS_ADAPTER.validate_python(orjson.loads(args))
+
+
+TOOLS_BY_NAME: dict[str, Type[TOOLS]] = {
+    tool.__name__: tool for tool in get_args(TOOLS)
+}
 
 
 def which_tool_name(name: str) -> Type[TOOLS]:
-    if name == "Confirmation":
-        return Confirmation
-    elif name == "BashCommand":
-        return BashCommand
-    elif name == "BashInteraction":
-        return BashInteraction
-    elif name == "ResetShell":
-        return ResetShell
-    elif name == "WriteIfEmpty":
-        return WriteIfEmpty
-    elif name == "FileEditFindReplace":
-        return FileEditFindReplace
-    elif name == "FileEdit":
-        return FileEdit
-    elif name == "AIAssistant":
-        return AIAssistant
-    elif name == "DoneFlag":
-        return DoneFlag
-    elif name == "ReadImage":
-        return ReadImage
-    elif name == "ReadFiles":
-        return ReadFiles
-    elif name == "Initialize":
-        return Initialize
-    elif name == "Mouse":
-        return Mouse
-    elif name == "Keyboard":
-        return Keyboard
-    elif name == "ScreenShot":
-        return ScreenShot
-    elif name == "GetScreenInfo":
-        return GetScreenInfo
-    elif name == "ContextSave":
-        return ContextSave
-    else:
+    tool = TOOLS_BY_NAME.get(name)
+    if tool is None:
         raise ValueError(f"Unknown tool name: {name}")
+    return tool
 
 
 TOOL_CALLS: list[TOOLS] = []
@@ -1232,8 +1212,7 @@ def get_tool_output(
 ) -> tuple[list[str | ImageData | DoneFlag], float]:
     global IS_IN_DOCKER, TOOL_CALLS, INITIALIZED
     if isinstance(args, dict):
-        adapter = TypeAdapter[TOOLS](TOOLS, config={"extra": "forbid"})
-        arg = adapter.validate_python(args)
+        arg = TOOLS_ADAPTER.validate_python(args)
     else:
         arg = args
     output: tuple[str | DoneFlag | ImageData, float]
@@ -1,8 +1,5 @@
 import asyncio
-import threading
-import time
 from importlib import metadata
-from typing import Any, Callable, Coroutine, DefaultDict, Optional
 from uuid import UUID
 
 import fastapi
@@ -44,14 +41,56 @@ class Mdata(BaseModel):
 
 app = fastapi.FastAPI()
 
-clients: dict[UUID, Callable[[Mdata], Coroutine[None, None, None]]] = {}
+# Outbound messages per client, drained by a single writer task per websocket
+clients: dict[UUID, asyncio.Queue[str]] = {}
 websockets: dict[UUID, WebSocket] = {}
-gpts: dict[UUID, Callable[[str], None]] = {}
-
-images: DefaultDict[UUID, dict[str, dict[str, Any]]] = DefaultDict(dict)
-
+# Futures of in-flight requests per client, resolved in order of the replies
+pending: dict[UUID, asyncio.Queue[asyncio.Future[str]]] = {}
 
 CLIENT_VERSION_MINIMUM = "2.7.0"
+OUTBOUND_QUEUE_SIZE = 1000
+SEND_TIMEOUT = 10.0
+REQUEST_TIMEOUT = 30.0
+
+
+def _fail_pending(user_pending: asyncio.Queue[asyncio.Future[str]]) -> None:
+    # Fail in-flight requests right away instead of letting them time out
+    while not user_pending.empty():
+        fut = user_pending.get_nowait()
+        if not fut.done():
+            fut.set_exception(ConnectionError("Client disconnected"))
+
+
+async def _drop_client(
+    user_id: UUID, websocket: WebSocket, code: int, reason: str
+) -> None:
+    # Remove the client, unless it has already reconnected with a new socket
+    if websockets.get(user_id) is websocket:
+        del clients[user_id]
+        del websockets[user_id]
+        _fail_pending(pending.pop(user_id))
+    try:
+        await websocket.close(code=code, reason=reason)
+    except RuntimeError:
+        # Already closed
+        pass
+
+
+async def _writer(
+    user_id: UUID, websocket: WebSocket, outq: asyncio.Queue[str]
+) -> None:
+    while True:
+        payload = await outq.get()
+        try:
+            await asyncio.wait_for(websocket.send_text(payload), timeout=SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Slow or stuck consumer, disconnect it so its requests fail fast
+            await _drop_client(user_id, websocket, 1013, "Client too slow to receive")
+            return
+        except (WebSocketDisconnect, RuntimeError):
+            # Connection already gone, nothing more can be sent on it
+            await _drop_client(user_id, websocket, 1011, "Send failed")
+            return
 
 
 @app.websocket("/v1/register/{uuid}")
@@ -79,24 +118,66 @@ async def register_websocket(websocket: WebSocket, uuid: UUID) -> None:
         )
         return
 
-    # Register the callback for this client UUID
-    async def send_data_callback(data: Mdata) -> None:
-        await websocket.send_text(data.model_dump_json())
+    # Register the outbound queue for this client UUID
+    outq: asyncio.Queue[str] = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+    writer = asyncio.create_task(_writer(uuid, websocket, outq))
+
+    user_pending: asyncio.Queue[asyncio.Future[str]] = asyncio.Queue()
 
-    clients[uuid] = send_data_callback
+    clients[uuid] = outq
     websockets[uuid] = websocket
+    pending[uuid] = user_pending
 
+    # Bound once, this loop runs for every message the client sends
+    receive_text = websocket.receive_text
+    next_pending = user_pending.get_nowait
     try:
         while True:
-            received_data = await websocket.receive_text()
-            if uuid not in gpts:
+            received_data = await receive_text()
+            try:
+                fut = next_pending()
+            except asyncio.QueueEmpty:
                 raise fastapi.HTTPException(status_code=400, detail="No call made")
-            gpts[uuid](received_data)
+            # The request may have already timed out, drop its late reply then
+            if not fut.done():
+                fut.set_result(received_data)
     except WebSocketDisconnect:
-        # Remove the client if the WebSocket is disconnected
-        del clients[uuid]
-        del websockets[uuid]
         print(f"Client {uuid} disconnected")
+    finally:
+        writer.cancel()
+        # Remove the client, unless it has already reconnected with a new socket
+        if websockets.get(uuid) is websocket:
+            del clients[uuid]
+            del websockets[uuid]
+            del pending[uuid]
+        _fail_pending(user_pending)
+
+
+async def send_and_wait(user_id: UUID, data: Mdata) -> str:
+    # Serialize once, the writer task only forwards the payload
+    payload = data.model_dump_json()
+    websocket = websockets[user_id]
+
+    try:
+        clients[user_id].put_nowait(payload)
+    except asyncio.QueueFull:
+        raise fastapi.HTTPException(
+            status_code=503, detail="Too many pending requests, retry later"
+        )
+
+    fut: asyncio.Future[str] = asyncio.get_running_loop().create_future()
+    pending[user_id].put_nowait(fut)
+
+    try:
+        return await asyncio.wait_for(fut, timeout=REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        # Replies carry no request id and are matched to requests in order, so
+        # once one is missing every later reply would go to the wrong caller.
+        # Drop the connection and fail the rest, the client reconnects afresh.
+        await _drop_client(user_id, websocket, 1011, "Request timed out")
+        raise fastapi.HTTPException(status_code=500, detail="Timeout error")
+    except ConnectionError:
+        raise fastapi.HTTPException(status_code=500, detail="Client disconnected")
 
 
 class WriteIfEmptyWithUUID(WriteIfEmpty):
@@ -109,23 +190,7 @@ async def create_file(write_file_data: WriteIfEmptyWithUUID) -> str:
     if user_id not in clients:
         return "Failure: id not found, ask the user to check it."
 
-    results: Optional[str] = None
-
-    def put_results(result: str) -> None:
-        nonlocal results
-        results = result
-
-    gpts[user_id] = put_results
-
-    await clients[user_id](Mdata(data=write_file_data, user_id=user_id))
-
-    start_time = time.time()
-    while time.time() - start_time < 30:
-        if results is not None:
-            return results
-        await asyncio.sleep(0.1)
-
-    raise fastapi.HTTPException(status_code=500, detail="Timeout error")
+    return await send_and_wait(user_id, Mdata(data=write_file_data, user_id=user_id))
 
 
 class FileEditWithUUID(FileEdit):
@@ -140,29 +205,14 @@ async def file_edit_find_replace(
     if user_id not in clients:
         return "Failure: id not found, ask the user to check it."
 
-    results: Optional[str] = None
-
-    def put_results(result: str) -> None:
-        nonlocal results
-        results = result
-
-    gpts[user_id] = put_results
-
-    await clients[user_id](
+    return await send_and_wait(
+        user_id,
         Mdata(
             data=file_edit_find_replace,
             user_id=user_id,
-        )
+        ),
     )
 
-    start_time = time.time()
-    while time.time() - start_time < 30:
-        if results is not None:
-            return results
-        await asyncio.sleep(0.1)
-
-    raise fastapi.HTTPException(status_code=500, detail="Timeout error")
-
 
 class ResetShellWithUUID(ResetShell):
     user_id: UUID
@@ -174,23 +224,7 @@ async def reset_shell(reset_shell: ResetShellWithUUID) -> str:
     if user_id not in clients:
         return "Failure: id not found, ask the user to check it."
 
-    results: Optional[str] = None
-
-    def put_results(result: str) -> None:
-        nonlocal results
-        results = result
-
-    gpts[user_id] = put_results
-
-    await clients[user_id](Mdata(data=reset_shell, user_id=user_id))
-
-    start_time = time.time()
-    while time.time() - start_time < 30:
-        if results is not None:
-            return results
-        await asyncio.sleep(0.1)
-
-    raise fastapi.HTTPException(status_code=500, detail="Timeout error")
+    return await send_and_wait(user_id, Mdata(data=reset_shell, user_id=user_id))
 
 
 class CommandWithUUID(BaseModel):
@@ -204,26 +238,11 @@ async def bash_command(command: CommandWithUUID) -> str:
     if user_id not in clients:
         return "Failure: id not found, ask the user to check it."
 
-    results: Optional[str] = None
-
-    def put_results(result: str) -> None:
-        nonlocal results
-        results = result
-
-    gpts[user_id] = put_results
-
-    await clients[user_id](
-        Mdata(data=BashCommand(command=command.command), user_id=user_id)
+    return await send_and_wait(
+        user_id,
+        Mdata(data=BashCommand(command=command.command), user_id=user_id),
     )
 
-    start_time = time.time()
-    while time.time() - start_time < 30:
-        if results is not None:
-            return results
-        await asyncio.sleep(0.1)
-
-    raise fastapi.HTTPException(status_code=500, detail="Timeout error")
-
 
 class BashInteractionWithUUID(BashInteraction):
     user_id: UUID
@@ -235,29 +254,14 @@ async def bash_interaction(bash_interaction: BashInteractionWithUUID) -> str:
     if user_id not in clients:
         return "Failure: id not found, ask the user to check it."
 
-    results: Optional[str] = None
-
-    def put_results(result: str) -> None:
-        nonlocal results
-        results = result
-
-    gpts[user_id] = put_results
-
-    await clients[user_id](
+    return await send_and_wait(
+        user_id,
         Mdata(
             data=bash_interaction,
             user_id=user_id,
-        )
+        ),
     )
 
-    start_time = time.time()
-    while time.time() - start_time < 30:
-        if results is not None:
-            return results
-        await asyncio.sleep(0.1)
-
-    raise fastapi.HTTPException(status_code=500, detail="Timeout error")
-
 
 class ReadFileWithUUID(ReadFiles):
     user_id: UUID
@@ -269,23 +273,7 @@ async def read_file_endpoint(read_file_data: ReadFileWithUUID) -> str:
     if user_id not in clients:
         return "Failure: id not found, ask the user to check it."
 
-    results: Optional[str] = None
-
-    def put_results(result: str) -> None:
-        nonlocal results
-        results = result
-
-    gpts[user_id] = put_results
-
-    await clients[user_id](Mdata(data=read_file_data, user_id=user_id))
-
-    start_time = time.time()
-    while time.time() - start_time < 30:
-        if results is not None:
-            return results
-        await asyncio.sleep(0.1)
-
-    raise fastapi.HTTPException(status_code=500, detail="Timeout error")
+    return await send_and_wait(user_id, Mdata(data=read_file_data, user_id=user_id))
 
 
 class InitializeWithUUID(Initialize):
@@ -298,23 +286,7 @@ async def initialize(initialize_data: InitializeWithUUID) -> str:
     if user_id not in clients:
         return "Failure: id not found, ask the user to check it."
 
-    results: Optional[str] = None
-
-    def put_results(result: str) -> None:
-        nonlocal results
-        results = result
-
-    gpts[user_id] = put_results
-
-    await clients[user_id](Mdata(data=initialize_data, user_id=user_id))
-
-    start_time = time.time()
-    while time.time() - start_time < 30:
-        if results is not None:
-            return results
-        await asyncio.sleep(0.1)
-
-    raise fastapi.HTTPException(status_code=500, detail="Timeout error")
+    return await send_and_wait(user_id, Mdata(data=initialize_data, user_id=user_id))
 
 
 class ContextSaveWithUUID(ContextSave):
@@ -327,23 +299,7 @@ async def context_save(context_save_data: ContextSaveWithUUID) -> str:
     if user_id not in clients:
         return "Failure: id not found, ask the user to check it."
 
-    results: Optional[str] = None
-
-    def put_results(result: str) -> None:
-        nonlocal results
-        results = result
-
-    gpts[user_id] = put_results
-
-    await clients[user_id](Mdata(data=context_save_data, user_id=user_id))
-
-    start_time = time.time()
-    while time.time() - start_time < 30:
-        if results is not None:
-            return results
-        await asyncio.sleep(0.1)
-
-    raise fastapi.HTTPException(status_code=500, detail="Timeout error")
+    return await send_and_wait(user_id, Mdata(data=context_save_data, user_id=user_id))
 
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -352,18 +308,14 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 def run() -> None:
     load_dotenv()
 
-    uvicorn_thread = threading.Thread(
-        target=uvicorn.run,
-        args=(app,),
-        kwargs={
-            "host": "0.0.0.0",
-            "port": 8000,
-            "log_level": "info",
-            "access_log": True,
-        },
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        log_level="info",
+        access_log=True,
     )
-    uvicorn_thread.start()
-    uvicorn_thread.join()
 
 
 if __name__ == "__main__":
@@ -61,7 +61,7 @@ def test_save_history(tmp_path):
             mock_file.assert_called_once()
             
             # Get all the written content by joining all write calls
-            written_content = ''
+            written_content = b''
             for call_args in mock_file().write.call_args_list:
                 written_content += call_args[0][0]
             
@@ -89,15 +89,90 @@ def test_parse_user_message_special_with_image(tmp_path):
     
     msg = f"%image {str(image_path)}\nSome text"
     
-    with patch('base64.b64encode', return_value=b"fake_base64"):
-        with patch('mimetypes.guess_type', return_value=("image/png", None)):
-            result = parse_user_message_special(msg)
-            assert result["role"] == "user"
-            assert isinstance(result["content"], list)
-            assert len(result["content"]) == 2
-            assert result["content"][0]["type"] == "image"
-            assert result["content"][0]["source"]["type"] == "base64"
-            assert result["content"][0]["source"]["media_type"] == "image/png"
-            assert result["content"][0]["source"]["data"] == "fake_base64"
-            assert result["content"][1]["type"] == "text"
-            assert result["content"][1]["text"] == "Some text"
\ No newline at end of file
+    with patch('mimetypes.guess_type', return_value=("image/png", None)):
+        result = parse_user_message_special(msg)
+        assert result["role"] == "user"
+        assert isinstance(result["content"], list)
+        assert len(result["content"]) == 2
+        assert result["content"][0]["type"] == "image"
+        assert result["content"][0]["source"]["type"] == "base64"
+        assert result["content"][0]["source"]["media_type"] == "image/png"
+        assert result["content"][0]["source"]["data"] == "ZmFrZSBpbWFnZSBkYXRh"
+        assert result["content"][1]["type"] == "text"
+        assert result["content"][1]["text"] == "Some text"
+
+def test_with_cache_breakpoint_marks_copy_of_last_message():
+    from wcgw.client.anthropic_client import _with_cache_breakpoint
+
+    history = [
+        {"role": "user", "content": "First message"},
+        {"role": "assistant", "content": [{"type": "text", "text": "Response"}]},
+    ]
+    marked = _with_cache_breakpoint(history)
+    assert marked[0] == history[0]
+    assert marked[1]["content"][-1]["cache_control"] == {"type": "ephemeral"}
+    # The stored history is left untouched
+    assert "cache_control" not in history[1]["content"][-1]
+
+    marked = _with_cache_breakpoint(history[:1])
+    assert marked[0]["content"] == [
+        {
+            "type": "text",
+            "text": "First message",
+            "cache_control": {"type": "ephemeral"},
+        }
+    ]
+
+
+def test_max_output_tokens_fits_budget():
+    from wcgw.client.anthropic_client import MAX_OUTPUT_TOKENS, _max_output_tokens
+
+    assert _max_output_tokens(10) == MAX_OUTPUT_TOKENS
+    # $15 per 1M output tokens
+    assert _max_output_tokens(0.015) == 1000
+    assert _max_output_tokens(0.015, 0.5) == 2000
+    assert _max_output_tokens(0) == 1
+    # The turn's prompt is paid for first
+    assert _max_output_tokens(0.02, 1, 0.005) == 1000
+    assert _max_output_tokens(0.03, 0.5, 0.03) == 2000
+    assert _max_output_tokens(0.01, 1, 0.02) == 1
+
+
+def test_input_cost_estimate():
+    from wcgw.client.anthropic_client import _input_cost_estimate
+
+    # Cache reads at $0.3 and writes at $3.75 per 1M tokens
+    assert _input_cost_estimate(0, 0) == 0
+    assert _input_cost_estimate(1_000_000, 0) == pytest.approx(0.3)
+    assert _input_cost_estimate(1_000_000, 1_000_000) == pytest.approx(4.05)
+
+
+def test_batched_message_failure_and_interrupt_cancel():
+    import asyncio
+    from unittest.mock import AsyncMock
+    from wcgw.client.anthropic_client import BatchedMessage, BatchFailed
+
+    async def results(batch_id):
+        async def gen():
+            yield MagicMock(result=MagicMock(type="expired"))
+
+        return gen()
+
+    client = MagicMock()
+    batches = client.messages.batches
+    batches.create = AsyncMock(
+        return_value=MagicMock(id="batch_1", processing_status="ended")
+    )
+    batches.results = results
+    with pytest.raises(BatchFailed, match="expired"):
+        asyncio.run(BatchedMessage(client, {}).__aenter__())
+
+    # Interrupted while polling, the batch is canceled
+    batches.create = AsyncMock(
+        return_value=MagicMock(id="batch_2", processing_status="in_progress")
+    )
+    batches.cancel = AsyncMock()
+    with patch("asyncio.sleep", AsyncMock(side_effect=asyncio.CancelledError)):
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(BatchedMessage(client, {}).__aenter__())
+    batches.cancel.assert_awaited_once_with("batch_2")
@@ -0,0 +1,9 @@
+from typer.testing import CliRunner
+
+from wcgw.client.cli import app
+
+
+def test_batch_requires_claude():
+    result = CliRunner().invoke(app, ["--batch"])
+    assert result.exit_code == 2
+    assert "--claude" in result.output
@@ -103,6 +103,18 @@ class TestToolsValidation(unittest.TestCase):
             result = truncate_if_over(long_content, max_tokens=None)
             self.assertEqual(result, long_content)
 
+    def test_truncate_if_over_skips_encoding_short_content(self):
+        """Test truncate_if_over doesn't tokenize content that surely fits"""
+        mock_enc = MagicMock()
+        with patch("wcgw.client.tools.default_enc", mock_enc):
+            self.assertEqual(truncate_if_over("short", max_tokens=21), "short")
+            mock_enc.encode.assert_not_called()
+
+            # 4 tokens per character is possible, this one must be checked
+            mock_enc.encode.return_value = MagicMock(ids=list(range(5)))
+            self.assertEqual(truncate_if_over("short", max_tokens=20), "short")
+            mock_enc.encode.assert_called_once_with("short")
+
     def test_which_tool(self):
         """Test which_tool function"""
         # Test BashCommand
@@ -0,0 +1,142 @@
+import asyncio
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+import fastapi
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+
+from wcgw.relay import serve
+
+
+@pytest.fixture
+def client():
+    with TestClient(serve.app) as test_client:
+        yield test_client
+    # Every test leaves the relay without registered clients
+    _wait_for(lambda: not serve.clients and not serve.websockets and not serve.pending)
+
+
+def _register(client, user_id):
+    ws = client.websocket_connect(f"/v1/register/{user_id}")
+    session = ws.__enter__()
+    session.receive_text()  # server version
+    session.send_text("2.8.2")
+    return ws, session
+
+
+def _wait_for(condition):
+    # The server side of a test websocket runs on the client's portal thread
+    for _ in range(200):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("condition not reached")
+
+
+def _wait_registered(user_id, websocket=None):
+    _wait_for(
+        lambda: user_id in serve.websockets
+        and serve.websockets[user_id] is not websocket
+    )
+    return serve.websockets[user_id]
+
+
+def _bash(client, user_id, command):
+    response = client.post(
+        "/v1/bash_command", json={"command": command, "user_id": str(user_id)}
+    )
+    return response.status_code, response.json()
+
+
+def test_replies_matched_in_order(client):
+    user_id = uuid.uuid4()
+    ws, session = _register(client, user_id)
+    _wait_registered(user_id)
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        futures = []
+        for i in range(3):
+            futures.append(pool.submit(_bash, client, user_id, f"echo {i}"))
+            # Received in the order the requests were sent
+            request = orjson.loads(session.receive_text())
+            assert request["data"]["command"] == f"echo {i}"
+        for i in range(3):
+            session.send_text(f"output {i}")
+        assert [f.result() for f in futures] == [(200, f"output {i}") for i in range(3)]
+    ws.__exit__(None, None, None)
+
+
+def test_timeout_drops_client_and_fails_pending(client, monkeypatch):
+    monkeypatch.setattr(serve, "REQUEST_TIMEOUT", 1.0)
+    user_id = uuid.uuid4()
+    ws, session = _register(client, user_id)
+    _wait_registered(user_id)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        first = pool.submit(_bash, client, user_id, "sleep 100")
+        session.receive_text()
+        time.sleep(0.5)
+        second = pool.submit(_bash, client, user_id, "ls")
+        session.receive_text()
+        # The first request times out, the second fails with the dropped client
+        # instead of waiting for its own timeout
+        assert first.result() == (500, {"detail": "Timeout error"})
+        assert second.result() == (500, {"detail": "Client disconnected"})
+    assert user_id not in serve.clients
+    message = session.receive()
+    assert message == {
+        "type": "websocket.close",
+        "code": 1011,
+        "reason": "Request timed out",
+    }
+    ws.__exit__(None, None, None)
+
+
+def test_full_outbound_queue_rejected():
+    async def send() -> None:
+        outq: asyncio.Queue[str] = asyncio.Queue(maxsize=1)
+        outq.put_nowait("queued")
+        serve.clients[user_id] = outq
+        serve.websockets[user_id] = MagicMock()
+        serve.pending[user_id] = asyncio.Queue()
+        try:
+            await serve.send_and_wait(
+                user_id, serve.Mdata(data="ping", user_id=user_id)
+            )
+        finally:
+            del serve.clients[user_id]
+            del serve.websockets[user_id]
+            del serve.pending[user_id]
+
+    user_id = uuid.uuid4()
+    with pytest.raises(fastapi.HTTPException) as exc_info:
+        asyncio.run(send())
+    assert exc_info.value.status_code == 503
+
+
+def test_reconnect_keeps_new_registration(client, capsys):
+    user_id = uuid.uuid4()
+    old_ws, _ = _register(client, user_id)
+    old_websocket = _wait_registered(user_id)
+    new_ws, new_session = _register(client, user_id)
+    _wait_registered(user_id, old_websocket)
+
+    # Closing the old socket leaves the new registration in place
+    old_ws.__exit__(None, None, None)
+    _wait_for(lambda: "disconnected" in capsys.readouterr().out)
+    assert user_id in serve.clients
+
+    reply = threading.Thread(
+        target=lambda: (new_session.receive_text(), new_session.send_text("done"))
+    )
+    reply.start()
+    assert _bash(client, user_id, "ls") == (200, "done")
+    reply.join()
+
+    new_ws.__exit__(None, None, None)
+    _wait_for(lambda: user_id not in serve.clients)
+    assert user_id not in serve.websockets
+    assert user_id not in serve.pending
@@ -1,14 +1,16 @@
+import asyncio
 import unittest
-from unittest.mock import patch, mock_open
+from unittest.mock import AsyncMock, MagicMock, patch, mock_open
 from wcgw.client.openai_client import (
     text_from_editor,
+    text_from_editor_async,
     save_history,
     parse_user_message_special,
     Config,
 )
 import os
 import tempfile
-import json
+import orjson
 from pathlib import Path
 
 
@@ -16,7 +18,7 @@ class TestBasic(unittest.TestCase):
     @patch("builtins.input", return_value="Test message")
     def test_text_from_editor_direct_input(self, mock_input):
         # Mock console
-        mock_console = patch("rich.console.Console").start()
+        mock_console = MagicMock()
         result = text_from_editor(mock_console)
         self.assertEqual(result, "Test message")
 
@@ -27,28 +29,50 @@ class TestBasic(unittest.TestCase):
         # Setup tempfile mock
         mock_tempfile.return_value.__enter__.return_value.name = "testfile.tmp"
         with patch("builtins.open", mock_open(read_data="Editor content")) as mock_file:
-            mock_console = patch("rich.console.Console").start()
+            mock_console = MagicMock()
             result = text_from_editor(mock_console)
             mock_run.assert_called_once()  # Ensure the editor was called
             mock_file.assert_called_with("testfile.tmp", "r")
             self.assertEqual(result, "Editor content")
 
+    @patch("builtins.input", return_value="Test message")
+    def test_text_from_editor_async_direct_input(self, mock_input):
+        mock_console = MagicMock()
+        result = asyncio.run(text_from_editor_async(mock_console))
+        self.assertEqual(result, "Test message")
+
+    @patch("tempfile.NamedTemporaryFile")
+    @patch("asyncio.create_subprocess_exec")
+    @patch("builtins.input", return_value="")
+    def test_text_from_editor_async_editor_input(
+        self, mock_input, mock_exec, mock_tempfile
+    ):
+        mock_tempfile.return_value.__enter__.return_value.name = "testfile.tmp"
+        mock_exec.return_value.wait = AsyncMock(return_value=0)
+        with patch("builtins.open", mock_open(read_data="Editor content")) as mock_file:
+            mock_console = MagicMock()
+            result = asyncio.run(text_from_editor_async(mock_console))
+            mock_exec.assert_called_once()  # Ensure the editor was called
+            mock_file.assert_called_with("testfile.tmp", "r")
+            self.assertEqual(result, "Editor content")
+
     def test_save_history(self):
         history = [
             {"role": "user", "content": "Message 1"},
             {"role": "assistant", "content": "Response"},
         ]
         session_id = "abc123"
-        expected_filename = ".wcgw/response_abc123.json"
-        with patch("builtins.open", mock_open()) as mock_file:
-            save_history(history, session_id)
-            mock_file.assert_called_with(Path(expected_filename), "w")
-            # Capture all write calls
-            write_calls = [call[0][0] for call in mock_file().write.call_args_list]
-            # Recreate the expected write content
-            expected_content = json.dumps(history, indent=3)
-            # Ensure joined write calls match the expected content
-            self.assertEqual("".join(write_calls), expected_content)
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                # The .wcgw directory is created on the first save
+                save_history(history, session_id)
+                saved = Path(".wcgw/response_abc123.json").read_bytes()
+            finally:
+                os.chdir(cwd)
+            expected_content = orjson.dumps(history, option=orjson.OPT_INDENT_2)
+            self.assertEqual(saved, expected_content)
 
     def test_parse_user_message_special(self):
         # Test parsing user message without special commands
@@ -57,14 +81,28 @@ class TestBasic(unittest.TestCase):
         self.assertEqual(result["content"][0]["text"], "Hello world")
 
         # Test parsing with special image command
-        with patch("builtins.open", mock_open(read_data=b"image data")):
-            with patch("mimetypes.guess_type", return_value=("image/png", None)):
-                message = "%image test.png"
-                result = parse_user_message_special(message)
-                self.assertEqual(result["content"][0]["type"], "image_url")
-                self.assertTrue(
-                    "data:image/png;base64," in result["content"][0]["image_url"]["url"]
-                )
+        # The image is memory mapped, so it has to be a real file
+        with tempfile.TemporaryDirectory() as tmpdir:
+            image_path = os.path.join(tmpdir, "test.png")
+            with open(image_path, "wb") as f:
+                f.write(b"image data")
+            message = f"%image {image_path}"
+            result = parse_user_message_special(message)
+            self.assertEqual(result["content"][0]["type"], "image_url")
+            self.assertEqual(
+                result["content"][0]["image_url"]["url"],
+                "data:image/png;base64,aW1hZ2UgZGF0YQ==",
+            )
+
+            # Text around the command is kept as one part per run of lines
+            message = f"line 1\nline 2\n%image {image_path}\nline 3"
+            result = parse_user_message_special(message)
+            self.assertEqual(
+                [part["type"] for part in result["content"]],
+                ["text", "image_url", "text"],
+            )
+            self.assertEqual(result["content"][0]["text"], "line 1\nline 2")
+            self.assertEqual(result["content"][2]["text"], "line 3")
 
 
 if __name__ == "__main__":
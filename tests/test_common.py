@@ -1,6 +1,21 @@
 import unittest
 from unittest.mock import patch, MagicMock
-from wcgw.client.common import discard_input, CostData
+from wcgw.client.common import (
+    discard_input,
+    CostData,
+    StreamPrinter,
+    append_history,
+    chat_consoles,
+    encode_image_file,
+    history_id,
+    image_media_type,
+    in_thread,
+    load_history,
+)
+import os
+import rich.console
+import tempfile
+from pathlib import Path
 import sys
 import termios
 import select
@@ -106,6 +121,136 @@ class TestCommon(unittest.TestCase):
         self.assertTrue("Warning: Unable to discard input" in error_message)
         self.assertTrue("Mock termios error" in error_message)
 
+    def test_append_and_load_history(self):
+        """Test appending history as JSON lines and loading it back"""
+        history = [
+            {"role": "system", "content": "System message"},
+            {"role": "user", "content": "Fix the bug"},
+            {"role": "assistant", "content": "Done"},
+        ]
+        myid = history_id(history, "abc123")
+        self.assertEqual(myid, "fix_the_bug_abc123")
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                append_history(history[:2], myid)
+                append_history(history[2:], myid)
+                path = Path(".wcgw") / (myid + ".jsonl")
+                self.assertEqual(load_history(path), history)
+
+                # A partially written last line is dropped
+                with open(path, "ab") as f:
+                    f.write(b'{"role": "us')
+                self.assertEqual(load_history(path), history)
+            finally:
+                os.chdir(cwd)
+
+    def test_append_history_stores_large_tool_outputs_once(self):
+        """Test repeated large tool outputs are written to one blob"""
+        output = "x" * 2000
+        history = [
+            {"role": "system", "content": "System message"},
+            {"role": "user", "content": "Read it twice"},
+            {"role": "tool", "content": output, "tool_call_id": "a0"},
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "tool_result",
+                        "tool_use_id": "b",
+                        "content": output,
+                    },
+                    {"type": "text", "text": "small"},
+                ],
+            },
+            {"role": "tool", "content": "small output", "tool_call_id": "c0"},
+        ]
+        myid = history_id(history, "abc123")
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                append_history(history, myid)
+                path = Path(".wcgw") / (myid + ".jsonl")
+                self.assertEqual(len(os.listdir(Path(".wcgw") / "blobs")), 1)
+                self.assertNotIn(output.encode(), path.read_bytes())
+                loaded = load_history(path)
+                self.assertEqual(loaded, history)
+                # Both references to the blob share the loaded string
+                self.assertIs(loaded[2]["content"], loaded[3]["content"][0]["content"])
+            finally:
+                os.chdir(cwd)
+
+    def test_stream_printer_batches_writes(self):
+        """Test StreamPrinter prints buffered chunks together"""
+        console = MagicMock()
+        printer = StreamPrinter(console, max_parts=3, max_delay=60)
+        printer.write("a")
+        printer.write("")
+        printer.write("b")
+        console.print.assert_not_called()
+
+        printer.write("c")
+        console.print.assert_called_once_with("abc", end="")
+
+        printer.write("d")
+        printer.flush()
+        console.print.assert_called_with("d", end="")
+        self.assertEqual(console.print.call_count, 2)
+
+    def test_history_id_short_history(self):
+        """Test history_id for a history without a second message"""
+        history = [{"role": "user", "content": "First message"}]
+        self.assertEqual(history_id(history, "abc123"), "_abc123")
+        history.append({"role": "assistant", "content": "Read /tmp/A file"})
+        self.assertEqual(history_id(history, "abc123"), "read__tmp_a_file_abc123")
+
+    def test_in_thread_runs_nested_event_loop(self):
+        """Test in_thread lets a nested asyncio.run work inside a running loop"""
+        import asyncio
+
+        async def inner(first_message, limit):
+            return first_message, limit
+
+        def nested_loop(first_message, limit):
+            return asyncio.run(inner(first_message, limit))
+
+        async def outer():
+            return in_thread(nested_loop)("task", 1.5)
+
+        self.assertEqual(asyncio.run(outer()), ("task", 1.5))
+
+    def test_chat_consoles_built_once(self):
+        """Test chat_consoles returns the same consoles on every call"""
+        chat_consoles.cache_clear()
+        self.addCleanup(chat_consoles.cache_clear)
+        with patch.object(
+            rich.console, "Console", side_effect=lambda **kw: MagicMock()
+        ):
+            consoles = chat_consoles()
+            self.assertIs(chat_consoles(), consoles)
+        self.assertEqual(len({id(c) for c in consoles}), 4)
+
+    def test_encode_image_file(self):
+        """Test encode_image_file for a regular and an empty file"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "image.png")
+            Path(path).write_bytes(b"image data")
+            self.assertEqual(encode_image_file(path), "aW1hZ2UgZGF0YQ==")
+            Path(path).write_bytes(b"")
+            self.assertEqual(encode_image_file(path), "")
+
+    def test_image_media_type(self):
+        """Test image_media_type for known and other extensions"""
+        self.assertEqual(image_media_type("shot.PNG"), "image/png")
+        self.assertEqual(image_media_type("dir.v2/photo.jpeg"), "image/jpeg")
+        with patch("mimetypes.guess_type", return_value=("image/bmp", None)) as guess:
+            self.assertEqual(image_media_type("scan.bmp"), "image/bmp")
+            guess.assert_called_once_with("scan.bmp")
+
 
 if __name__ == "__main__":
     unittest.main()